@@ -0,0 +1,462 @@
+# Stage-Synchronous Batch Execution
+#
+# Moves every sentence of a corpus through the IBUT stages one batch at a time.
+# Each round writes the prompts of one stage as a batch-request JSONL file in the
+# OpenAI batch format, hands it to a batch processor, and advances each
+# sentence's state machine with the responses:
+#
+#     understanding -> judgment -> feedback -> refinement -> judgment ... -> translation
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langcodes import Language
+
+import metrics
+from budget import estimate_tokens
+from model import cached_prompt_tokens
+from store import is_error
+
+logger = logging.getLogger(__name__)
+
+# Stages in pipeline order; each round runs the earliest stage any sentence is in
+BATCH_STAGES = ("understanding", "judgment", "feedback", "refinement", "translation")
+
+# Pipeline stage the LLM calls of a batch stage are attributed to in traces
+TRACE_STAGES = {
+    "understanding": "understanding",
+    "judgment": "judgment",
+    "feedback": "judgment",
+    "refinement": "refinement",
+    "translation": "translation",
+}
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+def batch_request(custom_id, model, prompt):
+    """
+    One line of a batch-request file
+
+    Returns:
+        dict: Chat completion request in the OpenAI batch format
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": CHAT_COMPLETIONS_URL,
+        "body": {
+            "model": getattr(model, "model_name", "unknown"),
+            "messages": [
+                {"role": "system", "content": getattr(model, "system_message", "")},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": getattr(model, "temperature", 1.0),
+        },
+    }
+
+
+def response_text(line):
+    """
+    Text of one line of a batch output file
+
+    Returns:
+        str: The completion, or an "Error: ..." string like LLMModel returns
+    """
+    if line.get("error"):
+        return f"Error: {line['error'].get('message', line['error'])}"
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") != 200:
+        error = body.get("error") or {}
+        return f"Error: {error.get('message', 'status code ' + str(response.get('status_code')))}"
+    return body["choices"][0]["message"]["content"]
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class LocalBatchProcessor:
+    """
+    Local stand-in for a batch endpoint
+
+    "Processes" a batch-request file by sending each request through a model's
+    `agenerate` (so the response cache, rate limiter and retries apply), and
+    writes the output file in the OpenAI batch output format.
+    """
+
+    def __init__(self, llm_model, max_in_flight=16, run=None):
+        """
+        Args:
+            llm_model: LLMModel, e.g. an OfflineLLMModel for testing
+            max_in_flight: Maximum number of requests sent at the same time
+            run: Optional callable(coroutine) running a coroutine to completion, e.g.
+                `IBUT._run` to send the requests on that instance's event loop and client;
+                by default each file is processed on a new event loop in a worker thread,
+                so an event loop running in the calling thread is not in the way
+        """
+        self.model = llm_model
+        self.max_in_flight = max_in_flight
+        self.run = run
+
+    def __call__(self, input_path, output_path):
+        requests = read_jsonl(input_path)
+        if self.run is not None:
+            responses = self.run(self._send(requests))
+        else:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                responses = executor.submit(asyncio.run, self._process(requests)).result()
+        write_jsonl(output_path, responses)
+
+    async def _process(self, requests):
+        try:
+            return await self._send(requests)
+        finally:
+            # The async client is bound to this round's event loop
+            aclose = getattr(self.model, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def _send(self, requests):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def process(number, request):
+            prompt = request["body"]["messages"][-1]["content"]
+            async with semaphore:
+                text = await self.model.agenerate(prompt)
+            if is_error(text):
+                # `response_text` adds the "Error:" prefix back
+                message = text[len("Error:"):].strip() if isinstance(text, str) else str(text)
+                response = {"status_code": 500, "request_id": f"local-{number}", "body": {"error": {"message": message}}}
+            else:
+                body = {
+                    "id": f"local-{number}",
+                    "object": "chat.completion",
+                    "model": request["body"]["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": estimate_tokens(prompt),
+                        "completion_tokens": estimate_tokens(text),
+                        "total_tokens": estimate_tokens(prompt) + estimate_tokens(text),
+                    },
+                }
+                response = {"status_code": 200, "request_id": f"local-{number}", "body": body}
+            return {"id": f"batch_req_{number}", "custom_id": request["custom_id"], "response": response, "error": None}
+
+        return await asyncio.gather(*(process(number, request) for number, request in enumerate(requests)))
+
+
+class OpenAIBatchProcessor:
+    """Batch processor submitting to the OpenAI Batch API and polling until the batch ends"""
+
+    def __init__(self, llm_model, completion_window="24h", poll_interval=30.0):
+        """
+        Args:
+            llm_model: LLMModel whose pooled client is used
+            completion_window: Completion window requested for each batch
+            poll_interval: Seconds between status checks
+        """
+        self.model = llm_model
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+
+    def __call__(self, input_path, output_path):
+        client = self.model._client()
+        with open(input_path, "rb") as file:
+            uploaded = client.files.create(file=file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id, endpoint=CHAT_COMPLETIONS_URL, completion_window=self.completion_window
+        )
+        logger.info("Submitted batch %s for %s", batch.id, input_path)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = client.batches.retrieve(batch.id)
+        if batch.status == "failed":
+            raise RuntimeError(f"batch {batch.id} failed: {batch.errors}")
+
+        # Expired and cancelled batches still return the requests that finished;
+        # the rest are missing from the output and come back as errors
+        with open(output_path, "wb") as file:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    file.write(client.files.content(file_id).read())
+
+
+class BatchRunner:
+    """
+    Stage-synchronous corpus translation
+
+    Every round sends the prompts of the earliest stage any sentence is in as one
+    batch; sentences that are done with refinement wait for the rest, so the
+    final translations go out as a single batch. Batch files are kept in
+    `directory`. A round whose output file was produced from identical requests
+    (recorded as a hash next to it) is ingested without being processed again,
+    so an interrupted run resumes where it stopped, while a different corpus in
+    the same directory is sent anew.
+    """
+
+    def __init__(self, ibut_translator, directory, processor=None):
+        """
+        Initialize batch runner
+
+        Args:
+            ibut_translator: IBUT instance whose prompts, judgment mode, token budget
+                and convergence detector are used
+            directory: Directory for the batch-request and output files
+            processor: Callable(input_path, output_path) processing a batch file;
+                defaults to a LocalBatchProcessor sending the requests through the
+                translator's model on the translator's event loop
+        """
+        self.ibut = ibut_translator
+        self.directory = directory
+        self.processor = processor or LocalBatchProcessor(ibut_translator.model, run=ibut_translator._run)
+        self.rounds = 0
+
+    def run(self, source_sentences, direction="zh-en"):
+        """
+        Translate a corpus
+
+        Returns:
+            list: Translations in input order
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.rounds = 0
+        states = [self._new_state(sentence, direction) for sentence in source_sentences]
+        while True:
+            pending = [state for state in states if state["stage"] is not None]
+            if not pending:
+                break
+            stage = min((state["stage"] for state in pending), key=BATCH_STAGES.index)
+            self._run_round(stage, [state for state in pending if state["stage"] == stage])
+
+        if self.ibut.trace_callback is not None:
+            for state in states:
+                self.ibut.trace_callback(state["trace"])
+        return [state["translation"] for state in states]
+
+    def _new_state(self, source_sentence, direction):
+        source_lang, target_lang = direction.split("-")
+        return {
+            "source": source_sentence,
+            "direction": direction,
+            "source_lang": Language.make(language=source_lang).display_name(),
+            "target_lang": Language.make(language=target_lang).display_name(),
+            "stage": "understanding",
+            "fused_understanding": self.ibut.fused_understanding,
+            "fused_judgment": self.ibut.judgment_mode == "fused",
+            "source_understanding": None,
+            "target_understanding": None,
+            "judgment_result": None,
+            "source_feedback": None,
+            "target_feedback": None,
+            "translation": None,
+            "trace": metrics.new_trace(source_sentence, direction),
+        }
+
+    def _run_round(self, stage, states):
+        """Send one stage's prompts of the given sentences as a batch and advance them"""
+        self.rounds += 1
+        name = os.path.join(self.directory, f"{self.rounds:03d}-{stage}")
+        input_path, output_path, digest_path = name + ".jsonl", name + ".output.jsonl", name + ".sha256"
+
+        requests = []
+        for number, state in enumerate(states):
+            for part, prompt in self._prompts(stage, state):
+                requests.append(batch_request(f"{number}-{stage}-{part}", self.ibut.model, prompt))
+        write_jsonl(input_path, requests)
+        with open(input_path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+
+        # Custom ids only encode positions, so an output is only reused for the very same requests
+        reusable = False
+        if os.path.exists(output_path) and os.path.exists(digest_path):
+            with open(digest_path, "r", encoding="utf-8") as file:
+                reusable = file.read().strip() == digest
+        if not reusable:
+            start = time.perf_counter()
+            self.processor(input_path, output_path)
+            with open(digest_path, "w", encoding="utf-8") as file:
+                file.write(digest + "\n")
+            logger.info("Batch %s: %d requests in %.1fs", name, len(requests), time.perf_counter() - start)
+        lines = {line["custom_id"]: line for line in read_jsonl(output_path)}
+        self.ibut.stats["llm_calls"] += len(requests)
+        self.ibut.stats["batch_requests"] += len(requests)
+
+        for number, state in enumerate(states):
+            responses = {}
+            for part, _ in self._prompts(stage, state):
+                line = lines.get(f"{number}-{stage}-{part}")
+                responses[part] = response_text(line) if line is not None else "Error: missing from batch output"
+                self._record(state, stage, line)
+            self._advance(stage, state, responses)
+
+    def _record(self, state, stage, line):
+        """Add a response's call and token usage to the sentence trace"""
+        name = TRACE_STAGES[stage]
+        entry = state["trace"]["stages"].setdefault(name, dict.fromkeys(metrics.STAGE_FIELDS, 0))
+        entry["calls"] += 1
+        usage = ((line or {}).get("response") or {}).get("body", {}).get("usage") or {}
+        entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        entry["cached_tokens"] += cached_prompt_tokens(usage)
+        entry["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    def _prompts(self, stage, state):
+        """
+        Prompts a sentence sends in a stage
+
+        Returns:
+            list: (part name, prompt) pairs
+        """
+        ibut = self.ibut
+        source = state["source"]
+        if stage == "understanding":
+            if state["fused_understanding"]:
+                return [("fused", ibut._create_fused_understanding_prompt(source, state["source_lang"], state["target_lang"]))]
+            return [
+                ("source", ibut._create_source_understanding_prompt(source, state["source_lang"])),
+                ("target", ibut._create_target_understanding_prompt(source, state["target_lang"])),
+            ]
+        if stage == "judgment":
+            if state["fused_judgment"]:
+                return [("fused", ibut._create_fused_alignment_judgment_prompt(
+                    source, state["source_understanding"], state["target_understanding"], state["direction"]
+                ))]
+            return [("verdict", ibut._create_alignment_judgment_prompt(
+                source, state["source_understanding"], state["target_understanding"], state["direction"]
+            ))]
+        if stage == "feedback":
+            return [
+                ("source", ibut._create_alignment_judgment_prompt_source_2(
+                    source, state["source_understanding"], state["judgment_result"], state["source_lang"]
+                )),
+                ("target", ibut._create_alignment_judgment_prompt_target_2(
+                    source, state["judgment_result"], state["target_understanding"], state["target_lang"]
+                )),
+            ]
+        if stage == "refinement":
+            return [
+                ("source", ibut._create_refinement_prompt(
+                    source, state["source_understanding"], state["source_feedback"], state["direction"], is_source=True
+                )),
+                ("target", ibut._create_refinement_prompt(
+                    source, state["target_understanding"], state["target_feedback"], state["direction"], is_source=False
+                )),
+            ]
+        return [("translation", ibut._create_translation_prompt(
+            source, state["source_understanding"], state["target_understanding"], state["direction"]
+        ))]
+
+    def _judgment_error(self, state, error):
+        """Translate a sentence with its current understandings after a failed judgment"""
+        self.ibut._judgment_error(error)
+        state["trace"]["outcome"] = "judgment_error"
+        state["stage"] = "translation"
+
+    def _advance(self, stage, state, responses):
+        """Move a sentence to its next stage given the responses of the current one"""
+        ibut = self.ibut
+        trace = state["trace"]
+        if stage == "understanding":
+            if state["fused_understanding"]:
+                try:
+                    understandings = ibut._parse_fused_understanding(responses["fused"])
+                except ValueError:
+                    # Ask again with separate prompts in the next round
+                    ibut.stats["fused_understanding_fallbacks"] += 1
+                    state["fused_understanding"] = False
+                    return
+                ibut.stats["fused_understandings"] += 1
+            else:
+                understandings = responses["source"], responses["target"]
+            error = ibut._understanding_error(*understandings)
+            if error is not None:
+                trace["outcome"] = "understanding_error"
+                state["translation"] = error
+                state["stage"] = None
+                return
+            state["source_understanding"], state["target_understanding"] = understandings
+            trace["outcome"] = "max_iterations" if ibut.max_iterations > 0 else "not_judged"
+            state["stage"] = "judgment" if ibut.max_iterations > 0 else "translation"
+
+        elif stage == "judgment":
+            if state["fused_judgment"]:
+                if is_error(responses["fused"]):
+                    trace["iterations"] += 1
+                    self._judgment_error(state, responses["fused"])
+                    return
+                try:
+                    is_aligned, source_feedback, target_feedback = ibut._parse_fused_judgment_result(responses["fused"])
+                except ValueError:
+                    ibut.stats["fused_judgment_fallbacks"] += 1
+                    state["fused_judgment"] = False
+                    return
+                ibut.stats["fused_judgments"] += 1
+                trace["iterations"] += 1
+                state["source_feedback"], state["target_feedback"] = source_feedback, target_feedback
+                next_stage = "refinement"
+            else:
+                # The separate judge answers "True" when the understandings differ
+                trace["iterations"] += 1
+                if is_error(responses["verdict"]):
+                    self._judgment_error(state, responses["verdict"])
+                    return
+                is_aligned = "True" not in responses["verdict"]
+                state["judgment_result"] = responses["verdict"]
+                next_stage = "feedback"
+            if is_aligned:
+                trace["outcome"] = "aligned"
+                state["stage"] = "translation"
+            else:
+                state["stage"] = next_stage
+            # A fused judgment that fell back is fused again in the next iteration
+            state["fused_judgment"] = ibut.judgment_mode == "fused"
+
+        elif stage == "feedback":
+            for feedback in (responses["source"], responses["target"]):
+                if is_error(feedback):
+                    self._judgment_error(state, feedback)
+                    return
+            state["source_feedback"], state["target_feedback"] = responses["source"], responses["target"]
+            state["stage"] = "refinement"
+
+        elif stage == "refinement":
+            error = next((responses[part] for part in ("source", "target") if is_error(responses[part])), None)
+            if error is not None:
+                # Translate with the last good understandings
+                ibut.stats["refinement_errors"] += 1
+                logger.warning("Refinement failed: %s", error)
+                trace["outcome"] = "refinement_error"
+                state["stage"] = "translation"
+                return
+            previous = (state["source_understanding"], state["target_understanding"])
+            state["source_understanding"], state["target_understanding"] = responses["source"], responses["target"]
+            state["stage"] = "judgment" if trace["iterations"] < ibut.max_iterations else "translation"
+            if ibut.convergence is not None:
+                decision = ibut.convergence.check(
+                    previous, (state["source_understanding"], state["target_understanding"])
+                )
+                decision["iteration"] = trace["iterations"]
+                trace["convergence"].append(decision)
+                if decision["converged"]:
+                    ibut.stats["converged_early"] += 1
+                    trace["outcome"] = "converged"
+                    state["stage"] = "translation"
+
+        else:
+            state["translation"] = responses["translation"]
+            state["stage"] = None
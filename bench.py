@@ -0,0 +1,220 @@
+# IBUT throughput and latency benchmark
+#
+# Runs the translate and corpus paths against the offline backend with simulated
+# latency, sweeping max_iterations, concurrency and the response cache, and writes
+# one JSON record per configuration so runs can be diffed across commits. Every
+# configuration runs in a fresh process, so its peak RSS is its own:
+#
+#     python bench.py --output bench.jsonl
+#     python bench.py --output new.jsonl --compare bench.jsonl
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ResponseCache
+from ibut import IBUT
+from metrics import Metrics
+from model import OfflineLLMModel, lognormal_latency
+from prompts import TranslationPrompts
+
+CULTURE_DIRECTIONS = ("es", "fr", "hi", "ta", "te", "zh")
+
+
+def load_common(limit):
+    """Source sentences of data/common, translated zh-en"""
+    with open("data/common/common.zh", "r", encoding="utf-8") as file:
+        sentences = [line.strip() for line in itertools.islice(file, limit)]
+    return "zh-en", sentences
+
+
+def load_culture(target, limit):
+    """Source column of result/culture-ibut-en-<target>.jsonl"""
+    with open(f"result/culture-ibut-en-{target}.jsonl", "r", encoding="utf-8") as file:
+        sentences = [json.loads(line)["src"] for line in itertools.islice(file, limit)]
+    return f"en-{target}", sentences
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MiB (ru_maxrss is in KiB on Linux)
+
+    The peak covers the whole life of the process, so it is only meaningful per
+    configuration because `run_isolated` runs each one in a process of its own.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_model(args, cache):
+    return OfflineLLMModel(
+        latency=lognormal_latency(args.latency, args.sigma),
+        alignment_pass_rate=args.pass_rate,
+        seed=args.seed,
+        cache=cache,
+    )
+
+
+def run_once(args, dataset, direction, sentences, workload, max_iterations, max_in_flight, cache_mode):
+    """
+    Benchmark one configuration
+
+    Returns:
+        dict: Configuration and measured throughput, latency and call counts
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResponseCache(f"{directory}/responses.sqlite") if cache_mode != "off" else None
+        if cache_mode == "warm":
+            # Fill the cache with an unmeasured pass first
+            warmup = IBUT(make_model(args, cache), max_iterations=max_iterations)
+            for _ in warmup.translate_corpus(sentences, direction, max_in_flight=max_in_flight):
+                pass
+            warmup.close()
+
+        collector = Metrics()
+        ibut_translator = IBUT(make_model(args, cache), max_iterations=max_iterations, trace_callback=collector)
+        start = time.perf_counter()
+        if workload == "translate":
+            for sentence in sentences:
+                ibut_translator.translate(sentence, direction)
+        else:
+            for _ in ibut_translator.translate_corpus(sentences, direction, max_in_flight=max_in_flight):
+                pass
+        elapsed = time.perf_counter() - start
+        ibut_translator.close()
+        if cache is not None:
+            cache.close()
+
+    latencies = [trace["wall_time"] for trace in collector.records]
+    summary = collector.summary()
+    prompt_tokens = sum(entry["prompt_tokens"] for entry in summary["stages"].values())
+    cached_tokens = sum(entry["cached_tokens"] for entry in summary["stages"].values())
+    return {
+        "commit": git_commit(),
+        "prompt_version": TranslationPrompts.version(),
+        "dataset": dataset,
+        "direction": direction,
+        "workload": workload,
+        "max_iterations": max_iterations,
+        "max_in_flight": max_in_flight if workload == "corpus" else 1,
+        "cache": cache_mode,
+        "sentences": len(sentences),
+        "elapsed": round(elapsed, 4),
+        "sentences_per_sec": round(len(sentences) / elapsed, 4),
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p95": round(percentile(latencies, 95), 4),
+        "latency_p99": round(percentile(latencies, 99), 4),
+        "llm_calls_per_sentence": round(summary["calls_per_sentence"], 3),
+        "cached_prompt_token_share": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_isolated(*arguments):
+    """Run `run_once` in a fresh interpreter, so state and peak RSS of earlier configurations do not carry over"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_once, *arguments).result()
+
+
+def config_key(record):
+    return tuple(record[key] for key in ("dataset", "workload", "max_iterations", "max_in_flight", "cache"))
+
+
+def compare(records, baseline_path, tolerance):
+    """
+    Report configurations whose throughput dropped by more than `tolerance`
+
+    Returns:
+        int: Number of regressions
+    """
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {config_key(record): record for record in map(json.loads, file)}
+    regressions = 0
+    for record in records:
+        previous = baseline.get(config_key(record))
+        if previous is None:
+            continue
+        change = record["sentences_per_sec"] / previous["sentences_per_sec"] - 1
+        if change < -tolerance:
+            regressions += 1
+            print(f"REGRESSION {config_key(record)}: {previous['sentences_per_sec']} -> "
+                  f"{record['sentences_per_sec']} sentences/sec ({change:+.1%})", file=sys.stderr)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="IBUT throughput and latency benchmark")
+    parser.add_argument("--datasets", default="common,culture-fr",
+                        help="comma-separated: common, culture-<es|fr|hi|ta|te|zh>")
+    parser.add_argument("--sample", type=int, default=24, help="sentences per dataset")
+    parser.add_argument("--workloads", default="translate,corpus", help="comma-separated: translate, corpus")
+    parser.add_argument("--max-iterations", default="0,1,3", help="comma-separated sweep")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated max_in_flight sweep (corpus only)")
+    parser.add_argument("--cache", default="off,warm", help="comma-separated: off, cold, warm")
+    parser.add_argument("--latency", type=float, default=0.02, help="median simulated call latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.3, help="log-normal sigma of the call latency")
+    parser.add_argument("--pass-rate", type=float, default=0.6, help="probability the judge finds alignment")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSONL file to write the records to")
+    parser.add_argument("--compare", help="baseline JSONL to check for throughput regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative throughput drop")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    split = lambda value: [item for item in value.split(",") if item]
+
+    records = []
+    for dataset in split(args.datasets):
+        if dataset == "common":
+            direction, sentences = load_common(args.sample)
+        elif dataset.startswith("culture-") and dataset[len("culture-"):] in CULTURE_DIRECTIONS:
+            direction, sentences = load_culture(dataset[len("culture-"):], args.sample)
+        else:
+            raise SystemExit(f"unknown dataset: {dataset}")
+
+        for workload, max_iterations, cache_mode in itertools.product(
+            split(args.workloads), map(int, split(args.max_iterations)), split(args.cache)
+        ):
+            concurrency = map(int, split(args.concurrency)) if workload == "corpus" else [1]
+            for max_in_flight in concurrency:
+                record = run_isolated(args, dataset, direction, sentences, workload, max_iterations, max_in_flight, cache_mode)
+                records.append(record)
+                print(json.dumps(record), flush=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+    if args.compare and compare(records, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Token Budget
+import math
+from collections import Counter
+
+# Default caps, in tokens, on the variable content (understandings, feedback,
+# judgments) of each stage's prompt; the source sentence is never cut
+DEFAULT_STAGE_CAPS = {
+    "judgment": 3000,
+    "feedback": 3000,
+    "refinement": 2000,
+    "translation": 3000,
+}
+
+TRUNCATION_MARKER = " [...]"
+
+
+def estimate_tokens(text):
+    """
+    Cheap token count estimate
+
+    Characters of Latin and other alphabetic scripts count about a quarter of a
+    token each; CJK, Indic and other scripts above U+0900 count one token each.
+
+    Returns:
+        int: Estimated number of tokens
+    """
+    wide = sum(1 for char in text if ord(char) >= 0x0900)
+    return math.ceil((len(text) - wide) / 4) + wide
+
+
+class TokenBudget:
+    """
+    Per-stage token budget for prompts
+
+    When the variable parts of a prompt exceed the stage cap, the budget is
+    shared out max-min fairly: parts smaller than an equal share are kept whole,
+    and the remaining parts are cut to the same size. Cut parts keep their
+    beginning, end on a line break where possible, and are marked with " [...]".
+    """
+
+    def __init__(self, caps=None, tokenizer=None):
+        """
+        Initialize token budget
+
+        Args:
+            caps: Dict of stage -> maximum tokens, merged over DEFAULT_STAGE_CAPS; None disables a stage cap
+            tokenizer: Callable(text) -> token count, defaults to `estimate_tokens`
+        """
+        self.caps = dict(DEFAULT_STAGE_CAPS)
+        if caps:
+            self.caps.update(caps)
+        self.tokenizer = tokenizer or estimate_tokens
+        self.tokens_saved = Counter()
+        self.truncations = Counter()
+
+    def count(self, text):
+        return self.tokenizer(text)
+
+    def fit(self, stage, **parts):
+        """
+        Fit the variable parts of a stage's prompt into the stage cap
+
+        Args:
+            stage: Stage name, e.g. "refinement"
+            **parts: Named text parts of the prompt
+
+        Returns:
+            dict: The parts, cut where needed
+        """
+        cap = self.caps.get(stage)
+        if cap is None:
+            return parts
+
+        sizes = {name: self.count(text) for name, text in parts.items()}
+        if sum(sizes.values()) <= cap:
+            return parts
+
+        # Max-min fair share: small parts stay whole, large parts split what is left
+        allowance = {}
+        remaining = cap
+        pending = sorted(sizes, key=sizes.get)
+        while pending:
+            share = remaining // len(pending)
+            name = pending[0]
+            if sizes[name] > share:
+                break
+            allowance[name] = sizes[name]
+            remaining -= sizes[name]
+            pending.pop(0)
+        for name in pending:
+            allowance[name] = remaining // len(pending)
+
+        fitted = {}
+        for name, text in parts.items():
+            if sizes[name] <= allowance[name]:
+                fitted[name] = text
+                continue
+            fitted[name] = self.truncate(text, allowance[name])
+            self.tokens_saved[stage] += sizes[name] - self.count(fitted[name])
+            self.truncations[stage] += 1
+        return fitted
+
+    def truncate(self, text, max_tokens):
+        """
+        Cut text to at most `max_tokens`, keeping its beginning
+
+        Returns:
+            str: The cut text followed by the truncation marker
+        """
+        budget = max_tokens - self.count(TRUNCATION_MARKER)
+        if budget <= 0:
+            return TRUNCATION_MARKER.strip()
+
+        # Longest prefix within budget
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        prefix = text[:low]
+
+        # Prefer ending on a line break if that keeps most of the prefix
+        line_end = prefix.rfind("\n")
+        if line_end >= len(prefix) // 2:
+            prefix = prefix[:line_end]
+        return prefix.rstrip() + TRUNCATION_MARKER
+
+    def report(self):
+        """
+        Budget counters
+
+        Returns:
+            dict: stage -> {"truncations", "tokens_saved"}
+        """
+        return {
+            stage: {"truncations": self.truncations[stage], "tokens_saved": self.tokens_saved[stage]}
+            for stage in self.truncations
+        }
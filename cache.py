@@ -0,0 +1,150 @@
+# Response Cache
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Fraction of `max_bytes` the cache is trimmed down to when it overflows
+EVICTION_LOW_WATER = 0.9
+
+# Puts between recounts of the stored bytes, which also picks up the writes of
+# other processes sharing the database file
+SIZE_RESYNC_EVERY = 64
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache for LLM responses
+
+    Responses are stored in SQLite, keyed by a hash of the model name, system
+    message, temperature and prompt. When the stored responses exceed `max_bytes`
+    the least recently used entries are evicted. Several processes may share one
+    database file: the stored size is recounted from the table every
+    `SIZE_RESYNC_EVERY` puts and before evicting, so the limit holds for their
+    combined writes, overshooting by at most a few recent puts per process.
+    """
+
+    def __init__(self, path="cache/responses.sqlite", max_bytes=512 * 1024 * 1024, read_only=False):
+        """
+        Initialize response cache
+
+        Args:
+            path: SQLite database file
+            max_bytes: Maximum total size of the stored responses, None for unbounded
+            read_only: Serve hits from an existing cache without writing to it
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+        self._bytes = self._stored_bytes()
+
+    def _stored_bytes(self):
+        """Total size of the stored responses, including those written by other processes"""
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, system_message, temperature, prompt):
+        """
+        Build the cache key of a request
+
+        Returns:
+            str: Hex digest identifying the request
+        """
+        payload = json.dumps([model_name, system_message, temperature, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached response
+
+        Returns:
+            str: Cached response, or None on a miss
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        """Store a response, evicting least recently used entries if the cache is full"""
+        if self.read_only:
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._bytes += size - (row[0] if row else 0)
+            self._puts += 1
+            if self._puts % SIZE_RESYNC_EVERY == 0:
+                self._bytes = self._stored_bytes()
+            if self.max_bytes is not None and self._bytes > self.max_bytes:
+                # Other processes may have evicted in the meantime
+                self._bytes = self._stored_bytes()
+                if self._bytes > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache is below its low-water mark"""
+        # Evict a little more than needed so a full cache does not evict on every put
+        low_water = self.max_bytes * EVICTION_LOW_WATER
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._bytes <= low_water:
+                break
+            evicted.append((key,))
+            self._bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        Cache counters
+
+        Returns:
+            dict: hits, misses, hit rate, number of entries and stored bytes
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self._bytes = self._stored_bytes()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": self._bytes,
+            }
+
+    def close(self):
+        """Close the underlying database"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,63 @@
+# Convergence Detection
+import difflib
+
+
+def ngram_jaccard(previous, current, n=3):
+    """
+    Character n-gram Jaccard similarity
+
+    Returns:
+        float: Similarity between 0 and 1
+    """
+    if previous == current:
+        return 1.0
+    previous_grams = {previous[i:i + n] for i in range(max(len(previous) - n + 1, 1))}
+    current_grams = {current[i:i + n] for i in range(max(len(current) - n + 1, 1))}
+    return len(previous_grams & current_grams) / len(previous_grams | current_grams)
+
+
+def edit_ratio(previous, current):
+    """
+    difflib similarity ratio (2 * matches / total length)
+
+    Returns:
+        float: Similarity between 0 and 1
+    """
+    if previous == current:
+        return 1.0
+    return difflib.SequenceMatcher(None, previous, current, autojunk=False).ratio()
+
+
+class ConvergenceDetector:
+    """
+    Detects stalled iterative refinement
+
+    Successive refined understandings are compared with a cheap local similarity;
+    once both the source and the target understanding changed less than the
+    threshold allows, refinement is considered converged.
+    """
+
+    def __init__(self, threshold=0.9, similarity=ngram_jaccard):
+        """
+        Initialize convergence detector
+
+        Args:
+            threshold: Minimum similarity of successive understandings to stop refining
+            similarity: Callable(previous, current) -> similarity between 0 and 1,
+                e.g. `ngram_jaccard` or `edit_ratio`
+        """
+        self.threshold = threshold
+        self.similarity = similarity
+
+    def check(self, previous_understandings, current_understandings):
+        """
+        Compare successive (source, target) understanding pairs
+
+        Returns:
+            dict: {"similarity": lowest similarity of the pair, "converged": bool}
+        """
+        similarity = min(
+            self.similarity(previous, current)
+            for previous, current in zip(previous_understandings, current_understandings)
+        )
+        return {"similarity": round(similarity, 4), "converged": similarity >= self.threshold}
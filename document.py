@@ -0,0 +1,179 @@
+# Document Segmentation
+#
+# Splits a document into translatable text segments and the wiki markup around
+# them, so the segments can be translated separately and put back in place:
+#
+#     ===Hydrography===;Watercourses:*to the west: the Cher*in the centre: ...
+#
+# becomes the markup "===", the segment "Hydrography", the markup "===;", the
+# segment "Watercourses:", the markup "*", the segment "to the west: the Cher", ...
+
+import re
+
+DEFAULT_MAX_SEGMENT_CHARS = 400
+
+# ==Heading== up to ======Heading======, with or without spaces inside
+_HEADING_RE = re.compile(r"(={2,6})([^=\n]+?)\1")
+# List item and definition markers, at the start of the document, a line, a
+# heading or another list item
+_ITEM_RE = re.compile(r"[*#;:]+\s*")
+# Inline bullets such as "...Hainneville...* Cycling"
+_INLINE_BULLET_RE = re.compile(r"\*+\s*")
+_SENTENCE_END_RE = re.compile(r"[.!?。！？]+[\"'”’)]*(\s+|(?<=[。！？]))")
+# Words after which a period does not end a sentence
+_ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "jr", "sr", "mt", "vs", "etc", "no", "e.g", "i.e", "cf", "ca"}
+
+
+class SegmentTranslationError(Exception):
+    """
+    Raised when segments of a document could not be translated
+
+    Attributes:
+        failed: Indices of the failed segments among the document's text segments
+        errors: "Error: ..." string of each failed segment, in the order of `failed`
+        translation: The document with the other segments translated and the failed ones
+            left in the source language, or None if no segment was translated
+    """
+
+    def __init__(self, failed, errors, translation=None):
+        super().__init__(f"{len(failed)} segment(s) failed, e.g. {errors[0]}")
+        self.failed = failed
+        self.errors = errors
+        self.translation = translation
+
+
+def _sentence_ends(text):
+    """Offsets right after each sentence boundary inside `text`, excluding its end"""
+    ends = []
+    for match in _SENTENCE_END_RE.finditer(text):
+        if match.end() >= len(text):
+            break
+        words = text[:match.start()].split()
+        word = words[-1].lower().rstrip(".") if words else ""
+        # Initials such as "U.S." or "J." and common abbreviations do not end a sentence
+        if text[match.start()] == "." and (word in _ABBREVIATIONS or re.fullmatch(r"(\w\.)*\w", word) and len(word.replace(".", "")) <= 2):
+            continue
+        ends.append(match.end())
+    return ends
+
+
+def split_sentences(text, max_segment_chars=DEFAULT_MAX_SEGMENT_CHARS):
+    """
+    Split a run of plain text into segments of whole sentences
+
+    Consecutive sentences are grouped as long as the group stays within
+    `max_segment_chars`; a longer single sentence is kept whole.
+
+    Returns:
+        list: Segments whose concatenation is `text`
+    """
+    segments = []
+    start = 0
+    previous_end = 0
+    for end in _sentence_ends(text) + [len(text)]:
+        if end - start > max_segment_chars and previous_end > start:
+            segments.append(text[start:previous_end])
+            start = previous_end
+        previous_end = end
+    segments.append(text[start:])
+    return [segment for segment in segments if segment]
+
+
+def _split_markup(text):
+    """
+    Split a document into markup and text runs
+
+    Returns:
+        list: ("markup" | "text", string) pairs whose concatenation is `text`
+    """
+    parts = []
+    position = 0
+    at_item_start = True
+    while position < len(text):
+        if at_item_start:
+            match = _ITEM_RE.match(text, position)
+            if match:
+                parts.append(("markup", match.group()))
+                position = match.end()
+                at_item_start = False
+                continue
+        heading = _HEADING_RE.match(text, position)
+        if heading:
+            parts.append(("markup", heading.group(1)))
+            parts.append(("text", heading.group(2)))
+            parts.append(("markup", heading.group(1)))
+            position = heading.end()
+            at_item_start = True
+            continue
+        if text[position] == "\n":
+            parts.append(("markup", "\n"))
+            position += 1
+            at_item_start = True
+            continue
+
+        # Plain text up to the next heading, line break or inline bullet
+        end = len(text)
+        for pattern in (_HEADING_RE, re.compile(r"\n"), _INLINE_BULLET_RE):
+            match = pattern.search(text, position)
+            if match and match.start() < end:
+                end = match.start()
+        if end == position:
+            # An inline bullet
+            match = _INLINE_BULLET_RE.match(text, position)
+            parts.append(("markup", match.group()))
+            position = match.end()
+            continue
+        parts.append(("text", text[position:end]))
+        position = end
+        at_item_start = False
+    return parts
+
+
+def segment(text, max_segment_chars=DEFAULT_MAX_SEGMENT_CHARS):
+    """
+    Split a document into markup and translatable segments
+
+    Leading and trailing whitespace of a segment is kept as markup, so segments
+    are sent without it and the layout survives translation.
+
+    Returns:
+        list: ("markup" | "text", string) pairs whose concatenation is `text`
+    """
+    parts = []
+    for kind, run in _split_markup(text):
+        if kind == "markup":
+            parts.append((kind, run))
+            continue
+        for piece in split_sentences(run, max_segment_chars):
+            stripped = piece.strip()
+            if not stripped:
+                parts.append(("markup", piece))
+                continue
+            leading = piece[:len(piece) - len(piece.lstrip())]
+            trailing = piece[len(piece.rstrip()):]
+            if leading:
+                parts.append(("markup", leading))
+            parts.append(("text", stripped))
+            if trailing:
+                parts.append(("markup", trailing))
+    return parts
+
+
+def plain_text(parts):
+    """Text of a segmented document without markup, for document-level understanding"""
+    return " ".join(text for kind, text in parts if kind == "text")
+
+
+def reassemble(parts, translations):
+    """
+    Put translated segments back between the markup
+
+    Args:
+        parts: Output of `segment`
+        translations: One translation per "text" part, in order
+
+    Returns:
+        str: The translated document
+    """
+    translations = iter(translations)
+    return "".join(next(translations).strip() if kind == "text" else text for kind, text in parts)
@@ -0,0 +1,251 @@
+# Corpus evaluation: BLEU and chrF over result JSONL files
+#
+# Streams {"src", "tgt", "hyp"} records and scores each file in its own process:
+#
+#     python evaluate.py result/*.jsonl --output scores.jsonl
+
+import argparse
+import json
+import math
+import os
+import re
+import string
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BLEU_MAX_ORDER = 4
+CHRF_MAX_ORDER = 6
+CHRF_BETA = 2
+
+# Multiplier of the rolling n-gram hash; arithmetic wraps around modulo 2**64
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+_CJK = "⺀-⿟぀-ヿ㄀-ㇿ㐀-䶿一-鿿가-힯豈-﫿＀-￯"
+_PUNCTUATION = re.escape(string.punctuation + "।॥“”‘’«»…—–、。，！？：；（）《》【】·")
+# CJK characters and punctuation are single tokens; everything else splits on
+# whitespace only, so Indic words keep their combining vowel signs and viramas
+_TOKEN_RE = re.compile(f"[{_CJK}]|[{_PUNCTUATION}]|[^\\s{_CJK}{_PUNCTUATION}]+")
+
+
+def tokenize(text):
+    """
+    Tokenize for BLEU
+
+    Returns:
+        list: Tokens; CJK characters and punctuation marks are tokens of their own
+    """
+    return _TOKEN_RE.findall(text)
+
+
+def chrf_characters(text):
+    """Characters chrF is computed over (whitespace removed)"""
+    return list(re.sub(r"\s+", "", text))
+
+
+class _Vocabulary:
+    """Maps tokens to integer ids"""
+
+    def __init__(self):
+        self.ids = {}
+
+    def encode(self, tokens):
+        ids = self.ids
+        return np.fromiter((ids.setdefault(token, len(ids) + 1) for token in tokens), dtype=np.uint64, count=len(tokens))
+
+
+def _ngram_keys(sequences, order):
+    """
+    Hash every n-gram of the given order, tagged with its sentence
+
+    Args:
+        sequences: List of uint64 token id arrays, one per sentence
+        order: n-gram order
+
+    Returns:
+        np.ndarray: One uint64 key per n-gram occurrence
+    """
+    keys = []
+    for sentence, ids in enumerate(sequences):
+        count = len(ids) - order + 1
+        if count <= 0:
+            continue
+        key = np.full(count, np.uint64(sentence + 1), dtype=np.uint64)
+        for offset in range(order):
+            key = key * _HASH_MULTIPLIER + ids[offset:offset + count]
+        keys.append(key)
+    if not keys:
+        return np.empty(0, dtype=np.uint64)
+    return np.concatenate(keys)
+
+
+def _clipped_matches(hypothesis_keys, reference_keys):
+    """
+    Sum over n-grams of min(hypothesis count, reference count)
+
+    Keys carry their sentence, so matches are clipped per sentence.
+    """
+    hypothesis_grams, hypothesis_counts = np.unique(hypothesis_keys, return_counts=True)
+    reference_grams, reference_counts = np.unique(reference_keys, return_counts=True)
+    _, hypothesis_index, reference_index = np.intersect1d(
+        hypothesis_grams, reference_grams, assume_unique=True, return_indices=True
+    )
+    return int(np.minimum(hypothesis_counts[hypothesis_index], reference_counts[reference_index]).sum())
+
+
+def ngram_statistics(hypotheses, references, max_order):
+    """
+    Corpus n-gram statistics
+
+    Args:
+        hypotheses: List of token id arrays
+        references: List of token id arrays
+        max_order: Highest n-gram order
+
+    Returns:
+        dict: Per-order lists of clipped matches, hypothesis n-grams and reference n-grams
+    """
+    stats = {"matches": [], "hypothesis": [], "reference": []}
+    for order in range(1, max_order + 1):
+        hypothesis_keys = _ngram_keys(hypotheses, order)
+        reference_keys = _ngram_keys(references, order)
+        stats["matches"].append(_clipped_matches(hypothesis_keys, reference_keys))
+        stats["hypothesis"].append(len(hypothesis_keys))
+        stats["reference"].append(len(reference_keys))
+    return stats
+
+
+def corpus_bleu(hypotheses, references):
+    """
+    Corpus BLEU (single reference, uniform weights, no smoothing)
+
+    Args:
+        hypotheses: List of token id arrays
+        references: List of token id arrays
+
+    Returns:
+        dict: BLEU score (0-100), brevity penalty and n-gram precisions
+    """
+    stats = ngram_statistics(hypotheses, references, BLEU_MAX_ORDER)
+    precisions = [
+        matches / total if total else 0.0 for matches, total in zip(stats["matches"], stats["hypothesis"])
+    ]
+    hypothesis_length = sum(len(ids) for ids in hypotheses)
+    reference_length = sum(len(ids) for ids in references)
+    if hypothesis_length == 0:
+        brevity_penalty = 0.0
+    elif hypothesis_length < reference_length:
+        brevity_penalty = math.exp(1 - reference_length / hypothesis_length)
+    else:
+        brevity_penalty = 1.0
+    if min(precisions) == 0:
+        score = 0.0
+    else:
+        score = brevity_penalty * math.exp(sum(math.log(p) for p in precisions) / BLEU_MAX_ORDER)
+    return {
+        "bleu": 100 * score,
+        "brevity_penalty": brevity_penalty,
+        "precisions": [100 * p for p in precisions],
+        "hypothesis_length": hypothesis_length,
+        "reference_length": reference_length,
+    }
+
+
+def corpus_chrf(hypotheses, references, beta=CHRF_BETA):
+    """
+    Corpus chrF (character n-grams up to order 6, whitespace removed)
+
+    Precision and recall are computed per order from corpus totals, averaged over
+    the orders, and combined into an F-beta score.
+
+    Returns:
+        float: chrF score (0-100)
+    """
+    stats = ngram_statistics(hypotheses, references, CHRF_MAX_ORDER)
+    precisions, recalls = [], []
+    for matches, hypothesis_total, reference_total in zip(stats["matches"], stats["hypothesis"], stats["reference"]):
+        if hypothesis_total and reference_total:
+            precisions.append(matches / hypothesis_total)
+            recalls.append(matches / reference_total)
+    if not precisions:
+        return 0.0
+    precision = sum(precisions) / len(precisions)
+    recall = sum(recalls) / len(recalls)
+    if precision + recall == 0:
+        return 0.0
+    return 100 * (1 + beta ** 2) * precision * recall / (beta ** 2 * precision + recall)
+
+
+def language_of(path):
+    """Target language of a result file, from names like culture-ibut-en-zh.jsonl; English otherwise"""
+    match = re.search(r"-([a-z]{2})-([a-z]{2})\.jsonl$", os.path.basename(path))
+    return match.group(2) if match else "en"
+
+
+def score_file(path, lang=None):
+    """
+    Score one result JSONL file
+
+    Returns:
+        dict: File, language, sentence count, BLEU and chrF
+    """
+    words = _Vocabulary()
+    characters = _Vocabulary()
+    hypothesis_tokens, reference_tokens = [], []
+    hypothesis_chars, reference_chars = [], []
+    skipped = 0
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            if not isinstance(record.get("hyp"), str) or not isinstance(record.get("tgt"), str):
+                skipped += 1
+                continue
+            hypothesis, reference = record["hyp"].strip(), record["tgt"].strip()
+            hypothesis_tokens.append(words.encode(tokenize(hypothesis)))
+            reference_tokens.append(words.encode(tokenize(reference)))
+            hypothesis_chars.append(characters.encode(chrf_characters(hypothesis)))
+            reference_chars.append(characters.encode(chrf_characters(reference)))
+
+    bleu = corpus_bleu(hypothesis_tokens, reference_tokens)
+    return {
+        "file": path,
+        "lang": lang or language_of(path),
+        "sentences": len(hypothesis_tokens),
+        "skipped": skipped,
+        "bleu": round(bleu["bleu"], 2),
+        "chrf": round(corpus_chrf(hypothesis_chars, reference_chars), 2),
+        "brevity_penalty": round(bleu["brevity_penalty"], 4),
+        "precisions": [round(p, 2) for p in bleu["precisions"]],
+    }
+
+
+def score_files(paths, workers=None):
+    """
+    Score result files in parallel, one process per file
+
+    Returns:
+        list: `score_file` results in the order of `paths`
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(score_file, paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Corpus BLEU and chrF of result JSONL files")
+    parser.add_argument("files", nargs="+", help="JSONL files with src, tgt and hyp fields")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("--output", help="JSONL file to write the scores to")
+    args = parser.parse_args()
+
+    scores = score_files(args.files, args.workers)
+    for score in scores:
+        print(f"{score['file']}\t{score['lang']}\t{score['sentences']} sentences\t"
+              f"BLEU {score['bleu']:.2f}\tchrF {score['chrf']:.2f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            for score in scores:
+                file.write(json.dumps(score, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
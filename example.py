@@ -2,6 +2,7 @@
 
 from model import LLMModel
 from ibut import IBUT
+import logging
 import os
 
 def setup_openai_model():
@@ -35,11 +36,9 @@ def batch_translate(sentences, source_lang="中文", target_lang="英文"):
     
     print(f"\Translate {len(sentences)} numbers,  from{source_lang}to{target_lang}...\n")
     
-    for i, sentence in enumerate(sentences):
+    # 并发翻译，结果按输入顺序返回
+    for i, sentence, translation in ibut_translator.translate_corpus(sentences, max_in_flight=4):
         print(f"[{i+1}/{len(sentences)}] source : {sentence}")
-        
-        # 执行翻译
-        translation = ibut_translator.translate(sentence)
         results.append(translation)
         
         print(f"Translation Results: {translation}\n")
@@ -80,4 +79,6 @@ def main():
     print("\n===== Endings =====")
 
 if __name__ == "__main__":
+    # Stage progress of IBUT is logged at INFO, prompts and understandings at DEBUG
+    logging.basicConfig(level=logging.INFO)
     main()
\ No newline at end of file
@@ -1,6 +1,38 @@
 # IBUT: Iterative Bilingual Understanding Translation
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
 from langcodes import Language
 
+import document
+import metrics
+from prompts import TranslationPrompts
+from store import is_error
+from terminology import extract_terms, format_known_terms
+
+logger = logging.getLogger(__name__)
+
+# Sentences finished out of order are buffered; at most this many multiples of
+# `max_in_flight` are dispatched ahead of the next sentence to be yielded
+CORPUS_REORDER_WINDOW = 4
+
+JUDGMENT_MODES = ("separate", "fused")
+
+
+async def _anext(iterator):
+    """Coroutine awaiting the next item of an async generator, for `IBUT._run`"""
+    return await iterator.__anext__()
+
+
+async def _aclose(iterator):
+    """Coroutine closing an async generator, for `IBUT._run`"""
+    await iterator.aclose()
+
 class IBUT:
     """
     IBUT (Iterative Bilingual Understanding Translation) Implementation Class
@@ -11,38 +43,208 @@ class IBUT:
     4. Understanding-Based Translation
     """
     
-    def __init__(self, llm_model, max_iterations=3):
+    def __init__(self, llm_model, max_iterations=3, judgment_mode="separate", fused_understanding=False,
+                 token_budget=None, convergence=None, trace_callback=None, speculative=False,
+                 translation_memory=None, terminology=None):
         """
         Initialize IBUT translation system
         
         Args:
             llm_model: Large language model for generating understanding and translation
             max_iterations: Maximum number of iterations, default is 3
+            judgment_mode: "separate" asks for the verdict and each feedback in its own call,
+                "fused" asks for all three in one call and falls back to "separate" if the
+                response cannot be parsed
+            fused_understanding: Request both understandings in one call by default,
+                falling back to two calls if the response cannot be split
+            token_budget: Optional TokenBudget capping the understandings, feedback and
+                judgments fed into each stage's prompt
+            convergence: Optional ConvergenceDetector that ends refinement once successive
+                understandings stop changing
+            trace_callback: Optional callable(trace) receiving the per-sentence trace dict
+                of every translated sentence, e.g. a `metrics.Metrics` collector
+            speculative: Translate from the initial understandings while the first alignment
+                judgment is running, and keep that translation if they turn out to be aligned
+            translation_memory: Optional TranslationMemory; exact matches are returned
+                without any LLM call, fuzzy matches are offered to the translation prompt
+                and skip or shorten refinement. Every new translation is added to it
+            terminology: Optional TerminologyCache; terms explained by earlier understandings
+                are offered to the understanding prompts of sentences containing them
         """
+        if judgment_mode not in JUDGMENT_MODES:
+            raise ValueError(f"judgment_mode must be one of {JUDGMENT_MODES}, got {judgment_mode!r}")
         self.model = llm_model
         self.max_iterations = max_iterations
+        self.judgment_mode = judgment_mode
+        self.fused_understanding = fused_understanding
+        self.token_budget = token_budget
+        self.convergence = convergence
+        self.trace_callback = trace_callback
+        self.speculative = speculative
+        self.translation_memory = translation_memory
+        self.terminology = terminology
+        # Counters such as the number of LLM calls made by this instance
+        self.stats = Counter()
+        # Event loop of the synchronous API, started on first use and kept until `close`,
+        # so the model's async client and connection pool are reused across calls
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+    
+    def _fit(self, stage, **parts):
+        """Fit prompt parts into the stage's token budget, if one is set"""
+        if self.token_budget is None:
+            return parts
+        return self.token_budget.fit(stage, **parts)
+    
+    def _background_loop(self):
+        """Return the event loop of the synchronous API, starting its thread on first use"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever, name="ibut-event-loop", daemon=True
+                )
+                self._loop_thread.start()
+            return self._loop
+    
+    def _run(self, coroutine):
+        """
+        Run a coroutine to completion on behalf of the synchronous API
+        
+        Coroutines run on one persistent event loop in a background thread, which
+        also lets the synchronous API be called from a thread whose own loop is
+        running (e.g. in a notebook).
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._background_loop())
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt: do not leave the coroutine running
+            future.cancel()
+            raise
+    
+    def close(self):
+        """Close the model's clients and stop the event loop of the synchronous API"""
+        with self._loop_lock:
+            loop, self._loop = self._loop, None
+            thread, self._loop_thread = self._loop_thread, None
+        if loop is not None:
+            aclose = getattr(self.model, "aclose", None)
+            if aclose is not None:
+                asyncio.run_coroutine_threadsafe(aclose(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        close = getattr(self.model, "close", None)
+        if close is not None:
+            close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    async def _agenerate(self, prompt):
+        """
+        Call the model without blocking the event loop
+        
+        Models without an `agenerate` method are run in a worker thread. Responses
+        served from the model's cache are not counted as LLM calls.
+        """
+        with metrics.llm_call() as call:
+            try:
+                agenerate = getattr(self.model, "agenerate", None)
+                if agenerate is not None:
+                    return await agenerate(prompt)
+                return await asyncio.to_thread(self.model.generate, prompt)
+            finally:
+                if not call["cache_hit"]:
+                    self.stats["llm_calls"] += 1
     
-    def generate_understanding(self, source_sentence,direction="zh-en"):
+    def generate_understanding(self, source_sentence,direction="zh-en", fused=None):
         """
         Generate contextual understanding for source and target languages
         
         Args:
             source_sentence: Source language sentence
+            fused: Request both understandings in one call; defaults to the instance setting
             
         Returns:
             tuple: (source understanding, target understanding)
         """
+        return self._run(self.generate_understanding_async(source_sentence, direction, fused=fused))
+    
+    async def generate_understanding_async(self, source_sentence, direction="zh-en", fused=None,
+                                           source_understanding=None):
+        """
+        Asynchronous version of `generate_understanding`; separate understandings are requested concurrently
+        
+        Args:
+            source_understanding: Optional source understanding computed beforehand, e.g. shared
+                by several directions; only the target understanding is generated then
+        """
         source_lang, target_lang = direction.split("-")
         source_lang = Language.make(language=source_lang).display_name()
         target_lang = Language.make(language=target_lang).display_name()
+        
+        source_terms, target_terms = self._known_terms(source_sentence, direction)
+        with metrics.stage("understanding"):
+            if source_understanding is not None:
+                target_understanding = await self._generate_target_understanding_async(
+                    source_sentence, target_lang, known_terms=target_terms
+                )
+                self._remember_terms(direction, source_understanding, target_understanding)
+                return source_understanding, target_understanding
+            
+            if fused if fused is not None else self.fused_understanding:
+                prompt = self._create_fused_understanding_prompt(
+                    source_sentence, source_lang, target_lang, known_terms=source_terms + target_terms
+                )
+                try:
+                    understandings = self._parse_fused_understanding(await self._agenerate(prompt))
+                except ValueError:
+                    self.stats["fused_understanding_fallbacks"] += 1
+                else:
+                    self.stats["fused_understandings"] += 1
+                    self._remember_terms(direction, *understandings)
+                    return understandings
 
-        # Generate source language contextual understanding
-        source_understanding = self._generate_source_understanding(source_sentence,source_lang)
+            # Source and target understandings are independent of each other
+            source_understanding, target_understanding = await asyncio.gather(
+                self._generate_source_understanding_async(source_sentence, source_lang, known_terms=source_terms),
+                self._generate_target_understanding_async(source_sentence, target_lang, known_terms=target_terms),
+            )
         
-        # Generate target language contextual understanding
-        target_understanding = self._generate_target_understanding(source_sentence,target_lang)
+            self._remember_terms(direction, source_understanding, target_understanding)
+            return source_understanding, target_understanding
+    
+    def _known_terms(self, source_sentence, direction):
+        """
+        Cached terms occurring in the sentence
         
-        return source_understanding, target_understanding
+        Returns:
+            tuple: (source-side terms, target-side terms), lists of (term, explanation)
+        """
+        if self.terminology is None:
+            return [], []
+        source_terms = self.terminology.lookup(source_sentence, direction, "source")
+        target_terms = self.terminology.lookup(source_sentence, direction, "target")
+        self.stats["known_terms"] += len(source_terms) + len(target_terms)
+        return source_terms, target_terms
+    
+    def _remember_terms(self, direction, source_understanding, target_understanding):
+        """Add the terms explained by new understandings to the terminology cache"""
+        if self.terminology is None:
+            return
+        source_terms = []
+        if not is_error(source_understanding):
+            self.terminology.update(direction, "source", source_understanding)
+            source_terms = [term for term, _ in extract_terms(source_understanding)]
+        if not is_error(target_understanding):
+            # Target terms are found through the source terms they explain
+            self.terminology.update(direction, "target", target_understanding, source_terms=source_terms)
     
     def _generate_source_understanding(self, source_sentence,source_lang):
         """
@@ -54,35 +256,95 @@ class IBUT:
         Returns:
             str: Source language contextual understanding
         """
+        return self._run(self._generate_source_understanding_async(source_sentence, source_lang))
+    
+    async def _generate_source_understanding_async(self, source_sentence, source_lang, known_terms=None):
         # Call LLM to generate source language contextual understanding
         # In actual implementation, appropriate prompts should be used to guide LLM
-        prompt = self._create_source_understanding_prompt(source_sentence,source_lang)
-        source_understanding = self.model.generate(prompt)
+        prompt = self._create_source_understanding_prompt(source_sentence,source_lang, known_terms=known_terms)
+        source_understanding = await self._agenerate(prompt)
         return source_understanding
     
     def _generate_target_understanding(self, source_sentence,target_lang):
+        return self._run(self._generate_target_understanding_async(source_sentence, target_lang))
+    
+    async def _generate_target_understanding_async(self, source_sentence, target_lang, known_terms=None):
         # Call LLM to generate target language contextual understanding
-        prompt = self._create_target_understanding_prompt(source_sentence,target_lang)
-        target_understanding = self.model.generate(prompt)
+        prompt = self._create_target_understanding_prompt(source_sentence,target_lang, known_terms=known_terms)
+        target_understanding = await self._agenerate(prompt)
         return target_understanding
     
-    def _create_source_understanding_prompt(self, source_sentence,source_lang):
-        # Prompts should be adjusted based on specific language pairs and tasks
-        prompt = f"""Please fully understand the meaning of the following {source_lang} text and describe your understanding of key concepts, definitions, examples, and explanations of specific terms related to the translation task in {source_lang}:
-        
-        source_sentence: {source_sentence}
-        """
-        return prompt
+    def _create_source_understanding_prompt(self, source_sentence,source_lang, known_terms=None):
+        return TranslationPrompts.UNDERSTANDING.render(
+            language=source_lang,
+            known_terms=format_known_terms(known_terms or []),
+            sentence=source_sentence,
+        )
+    
+    def _create_target_understanding_prompt(self, source_sentence,target_lang, known_terms=None):
+        return TranslationPrompts.UNDERSTANDING.render(
+            language=target_lang,
+            known_terms=format_known_terms(known_terms or []),
+            sentence=source_sentence,
+        )
+    
+    def _create_fused_understanding_prompt(self, source_sentence, source_lang, target_lang, known_terms=None):
+        return TranslationPrompts.FUSED_UNDERSTANDING.render(
+            source_language=source_lang,
+            target_language=target_lang,
+            known_terms=format_known_terms(known_terms or []),
+            sentence=source_sentence,
+        )
     
-    def _create_target_understanding_prompt(self, source_sentence,target_lang):
-        # Prompts should be adjusted based on specific language pairs and tasks
-        prompt = f"""Please fully understand the meaning of the following {target_lang} text and describe your understanding of key concepts, definitions, examples, and explanations of specific terms related to the translation task in {target_lang}:
+    def _parse_fused_understanding(self, response):
+        """
+        Split a fused understanding response into its two sections
         
-        source_sentence: {source_sentence}
+        Returns:
+            tuple: (source understanding, target understanding)
+            
+        Raises:
+            ValueError: If either section is missing or empty
         """
-        return prompt
+        match = re.search(
+            r"\[SOURCE UNDERSTANDING\](.*?)\[TARGET UNDERSTANDING\](.*)", response, re.DOTALL | re.IGNORECASE
+        )
+        if not match:
+            raise ValueError("fused understanding without both sections")
+        source_understanding = match.group(1).strip()
+        target_understanding = match.group(2).strip()
+        if not source_understanding or not target_understanding:
+            raise ValueError("fused understanding with an empty section")
+        return source_understanding, target_understanding
     
     def alignment_judgment(self, source_sentence, source_understanding, target_understanding,direction):
+        return self._run(self.alignment_judgment_async(
+            source_sentence, source_understanding, target_understanding, direction
+        ))
+    
+    async def alignment_judgment_async(self, source_sentence, source_understanding, target_understanding, direction):
+        with metrics.stage("judgment"):
+            if self.judgment_mode == "fused":
+                prompt = self._create_fused_alignment_judgment_prompt(
+                    source_sentence, source_understanding, target_understanding, direction
+                )
+                judgment_result = await self._agenerate(prompt)
+                # Only a response that cannot be parsed falls back to the separate calls
+                if is_error(judgment_result):
+                    return self._judgment_error(judgment_result)
+                try:
+                    result = self._parse_fused_judgment_result(judgment_result)
+                except ValueError:
+                    self.stats["fused_judgment_fallbacks"] += 1
+                else:
+                    self.stats["fused_judgments"] += 1
+                    return result
+        
+            return await self._separate_alignment_judgment_async(
+                source_sentence, source_understanding, target_understanding, direction
+            )
+    
+    async def _separate_alignment_judgment_async(self, source_sentence, source_understanding, target_understanding, direction):
         # Call LLM as judgment agent (JA) to evaluate consistency
         source_lang, target_lang = direction.split("-")
 
@@ -91,14 +353,22 @@ class IBUT:
 
         
         prompt = self._create_alignment_judgment_prompt(source_sentence, source_understanding, target_understanding,direction)
-        judgment_result = self.model.generate(prompt)
+        judgment_result = await self._agenerate(prompt)
+        if is_error(judgment_result):
+            return self._judgment_error(judgment_result)
         
         if "True" in judgment_result:
             prompt_source = self._create_alignment_judgment_prompt_source_2(source_sentence, source_understanding, judgment_result, source_lang)
             prompt_target = self._create_alignment_judgment_prompt_target_2(source_sentence, judgment_result, target_understanding, target_lang)
             is_aligned = False
-            source_feedback = self.model.generate(prompt_source)
-            target_feedback = self.model.generate(prompt_target)
+            # Source and target feedback are independent of each other
+            source_feedback, target_feedback = await asyncio.gather(
+                self._agenerate(prompt_source),
+                self._agenerate(prompt_target),
+            )
+            for feedback in (source_feedback, target_feedback):
+                if is_error(feedback):
+                    return self._judgment_error(feedback)
         else:
             is_aligned = True
             source_feedback = ""
@@ -106,119 +376,779 @@ class IBUT:
             
         return is_aligned, source_feedback, target_feedback
     
+    def _judgment_error(self, error):
+        """
+        Result of a judgment whose verdict or feedback call failed
+        
+        The understandings are not known to be aligned, but there is no feedback to
+        refine them with either, so refinement stops with outcome "judgment_error".
+        
+        Returns:
+            tuple: (False, None, None)
+        """
+        self.stats["judgment_errors"] += 1
+        logger.warning("Alignment judgment failed: %s", error)
+        return False, None, None
+    
+    def _understanding_error(self, source_understanding, target_understanding):
+        """
+        Error of a failed understanding call, if any
+        
+        Returns:
+            str: The first "Error: ..." understanding, or None if both succeeded
+        """
+        for understanding in (source_understanding, target_understanding):
+            if is_error(understanding):
+                self.stats["understanding_errors"] += 1
+                logger.warning("Understanding generation failed: %s", understanding)
+                return understanding
+        return None
+    
     def _create_alignment_judgment_prompt(self, source_sentence, source_understanding, target_understanding, direction):
         source_lang, target_lang = direction.split("-")
         source_lang = Language.make(language=source_lang).display_name()
         target_lang = Language.make(language=target_lang).display_name()
+        parts = self._fit("judgment", source_understanding=source_understanding, target_understanding=target_understanding)
+        source_understanding, target_understanding = parts["source_understanding"], parts["target_understanding"]
 
-        prompt = f"""If you are a {source_lang} and {target_lang} linguist, determine whether provided source contextual understanding {source_understanding} and target contextual understanding {target_understanding}, based on the source sentence {source_sentence}, convey different key concepts, definitions, examples, and explanations of specific terms related to the translation task. If so, provide a "True" response; otherwise, give a "False" response."""
-        
-        return prompt
+        return TranslationPrompts.ALIGNMENT_JUDGMENT.render(
+            source_language=source_lang,
+            target_language=target_lang,
+            sentence=source_sentence,
+            source_understanding=source_understanding,
+            target_understanding=target_understanding,
+        )
     
     def _create_alignment_judgment_prompt_source_2(self, source_sentence, source_understanding, judgment_result, language_type):
-        prompt = f"""If you are a {language_type} linguist, based on the core meaning of the source sentence {source_sentence}, analyze the contextual understanding {judgment_result}. Generate verbal feedback in the language of {language_type} to correct any current errors in {source_understanding}."""
-       
-        return prompt
+        parts = self._fit("feedback", source_understanding=source_understanding, judgment_result=judgment_result)
+        source_understanding, judgment_result = parts["source_understanding"], parts["judgment_result"]
+        return TranslationPrompts.FEEDBACK.render(
+            language=language_type,
+            sentence=source_sentence,
+            judgment=judgment_result,
+            understanding=source_understanding,
+        )
     
     def _create_alignment_judgment_prompt_target_2(self, source_sentence, judgment_result, target_understanding, language_type):
-        prompt = f"""If you are a {language_type} linguist, based on the core meaning of the source sentence {source_sentence}, analyze the contextual understanding {judgment_result}. Generate verbal feedback in the language of {language_type} to correct any current errors in {target_understanding}."""
+        parts = self._fit("feedback", target_understanding=target_understanding, judgment_result=judgment_result)
+        target_understanding, judgment_result = parts["target_understanding"], parts["judgment_result"]
+        return TranslationPrompts.FEEDBACK.render(
+            language=language_type,
+            sentence=source_sentence,
+            judgment=judgment_result,
+            understanding=target_understanding,
+        )
+    
+    def _create_fused_alignment_judgment_prompt(self, source_sentence, source_understanding, target_understanding, direction):
+        source_lang, target_lang = direction.split("-")
+        source_lang = Language.make(language=source_lang).display_name()
+        target_lang = Language.make(language=target_lang).display_name()
+        parts = self._fit("judgment", source_understanding=source_understanding, target_understanding=target_understanding)
+        
+        return TranslationPrompts.FUSED_ALIGNMENT_JUDGMENT.render(
+            source_language=source_lang,
+            target_language=target_lang,
+            sentence=source_sentence,
+            **parts,
+        )
+    
+    def _parse_fused_judgment_result(self, judgment_result):
+        """
+        Parse a fused judgment response, either JSON or the line format of `_parse_judgment_result`
+        
+        Returns:
+            tuple: (is_aligned, source feedback, target feedback)
+            
+        Raises:
+            ValueError: If the response is in neither format or lacks feedback for a misaligned verdict
+        """
+        match = re.search(r"\{.*\}", judgment_result, re.DOTALL)
+        if match:
+            try:
+                result = json.loads(match.group(0))
+            except json.JSONDecodeError:
+                result = None
+            if isinstance(result, dict) and isinstance(result.get("aligned"), bool):
+                is_aligned = result["aligned"]
+                source_feedback = str(result.get("source_feedback") or "").strip()
+                target_feedback = str(result.get("target_feedback") or "").strip()
+            else:
+                is_aligned, source_feedback, target_feedback = self._parse_judgment_result(judgment_result)
+        else:
+            is_aligned, source_feedback, target_feedback = self._parse_judgment_result(judgment_result)
         
-        return prompt
+        if is_aligned:
+            return True, "", ""
+        if not source_feedback or not target_feedback:
+            raise ValueError("misaligned judgment without feedback")
+        return False, source_feedback, target_feedback
     
     def _parse_judgment_result(self, judgment_result):
+        """
+        Parse a line-format judgment response
+        
+            Consistency: True/False
+            Source feedback: ...
+            Target feedback: ...
+        
+        Feedback may continue on the following lines.
+        
+        Raises:
+            ValueError: If the first line holds no True/False verdict
+        """
         lines = judgment_result.strip().split('\n')
-        is_aligned = 'True' in lines[0]
-        
-        source_feedback = ''
-        target_feedback = ''
-        
-        if not is_aligned and len(lines) > 1:
-            # Extract source language feedback
-            for i, line in enumerate(lines):
-                if 'Source feedback:' in line and i+1 < len(lines):
-                    source_feedback = line.replace('Source feedback:', '').strip()
-                    if not source_feedback and i+1 < len(lines):
-                        source_feedback = lines[i+1].strip()
-                
-                if 'Target feedback:' in line and i+1 < len(lines):
-                    target_feedback = line.replace('Target feedback:', '').strip()
-                    if not target_feedback and i+1 < len(lines):
-                        target_feedback = lines[i+1].strip()
+        if 'True' in lines[0]:
+            is_aligned = True
+        elif 'False' in lines[0]:
+            is_aligned = False
+        else:
+            raise ValueError(f"no verdict in judgment: {lines[0]!r}")
+        
+        feedback = {'source': [], 'target': []}
+        current = None
+        for line in lines[1:]:
+            label = line.strip().lower()
+            if label.startswith('source feedback:') or label.startswith('source language feedback:'):
+                current = 'source'
+                line = line.split(':', 1)[1]
+            elif label.startswith('target feedback:') or label.startswith('target language feedback:'):
+                current = 'target'
+                line = line.split(':', 1)[1]
+            if current is not None and line.strip():
+                feedback[current].append(line.strip())
         
+        source_feedback = '\n'.join(feedback['source'])
+        target_feedback = '\n'.join(feedback['target'])
         return is_aligned, source_feedback, target_feedback
     
     def iterative_refinement(self, source_sentence, source_understanding, target_understanding,direction):
+        return self._run(self.iterative_refinement_async(
+            source_sentence, source_understanding, target_understanding, direction
+        ))
+    
+    async def iterative_refinement_async(self, source_sentence, source_understanding, target_understanding, direction,
+                                         initial_judgment=None, max_iterations=None):
+        """
+        Asynchronous version of `iterative_refinement`
+        
+        Args:
+            initial_judgment: Optional result of `alignment_judgment_async` on the given
+                understandings, used instead of judging them again in the first iteration
+            max_iterations: Optional limit for this sentence instead of `self.max_iterations`
+        """
+        if max_iterations is None:
+            max_iterations = self.max_iterations
         current_source_understanding = source_understanding
         current_target_understanding = target_understanding
+        trace = metrics.current_trace()
+        outcome = "max_iterations" if max_iterations > 0 else "not_judged"
         
-        for iteration in range(self.max_iterations):
+        for iteration in range(max_iterations):
             # Perform alignment judgment
-            is_aligned, source_feedback, target_feedback = self.alignment_judgment(
-                source_sentence, current_source_understanding, current_target_understanding,direction
-            )
+            if iteration == 0 and initial_judgment is not None:
+                is_aligned, source_feedback, target_feedback = initial_judgment
+            else:
+                is_aligned, source_feedback, target_feedback = await self.alignment_judgment_async(
+                    source_sentence, current_source_understanding, current_target_understanding,direction
+                )
+            if trace is not None:
+                trace["iterations"] = iteration + 1
             
             # If aligned, end iteration
             if is_aligned:
+                outcome = "aligned"
+                break
+            # A failed judgment gives nothing to refine with
+            if source_feedback is None:
+                outcome = "judgment_error"
                 break
             
-            # Optimize source language understanding based on feedback
-            current_source_understanding = self._refine_understanding(
-                source_sentence, current_source_understanding, source_feedback,direction, is_source=True
-            )
+            # Optimize source and target language understanding based on feedback
+            previous_understandings = (current_source_understanding, current_target_understanding)
+            with metrics.stage("refinement"):
+                current_source_understanding, current_target_understanding = await asyncio.gather(
+                    self._refine_understanding_async(
+                        source_sentence, current_source_understanding, source_feedback, direction, is_source=True
+                    ),
+                    self._refine_understanding_async(
+                        source_sentence, current_target_understanding, target_feedback, direction, is_source=False
+                    ),
+                )
+            # A failed refinement keeps the last good understandings
+            refined = (current_source_understanding, current_target_understanding)
+            error = next((understanding for understanding in refined if is_error(understanding)), None)
+            if error is not None:
+                self.stats["refinement_errors"] += 1
+                logger.warning("Refinement failed: %s", error)
+                current_source_understanding, current_target_understanding = previous_understandings
+                outcome = "refinement_error"
+                break
             
-            # Optimize target language understanding based on feedback
-            current_target_understanding = self._refine_understanding(
-                source_sentence, current_target_understanding, target_feedback,direction, is_source=False
-            )
+            # Stop once refinement no longer changes the understandings
+            if self.convergence is not None:
+                decision = self.convergence.check(
+                    previous_understandings, (current_source_understanding, current_target_understanding)
+                )
+                decision["iteration"] = iteration + 1
+                if trace is not None:
+                    trace["convergence"].append(decision)
+                if decision["converged"]:
+                    self.stats["converged_early"] += 1
+                    outcome = "converged"
+                    break
         
+        if trace is not None:
+            trace["outcome"] = outcome
         return current_source_understanding, current_target_understanding
     
     def _refine_understanding(self, source_sentence, current_understanding, feedback, direction, is_source=True):
+        return self._run(self._refine_understanding_async(
+            source_sentence, current_understanding, feedback, direction, is_source=is_source
+        ))
+    
+    async def _refine_understanding_async(self, source_sentence, current_understanding, feedback, direction, is_source=True):
+        prompt = self._create_refinement_prompt(source_sentence, current_understanding, feedback, direction, is_source)
+        refined_understanding = await self._agenerate(prompt)
+        return refined_understanding
+    
+    def _create_refinement_prompt(self, source_sentence, current_understanding, feedback, direction, is_source=True):
         source_lang, target_lang = direction.split("-")
         source_lang = Language.make(language=source_lang).display_name()
         target_lang = Language.make(language=target_lang).display_name()
-        language_type = source_lang if is_source else target_lang
+        parts = self._fit("refinement", current_understanding=current_understanding, feedback=feedback)
         
-        prompt = f"""If you are a linguist proficient in both {source_lang} and {target_lang}, based on the core meaning of the source sentence {source_sentence} and the opinions from {feedback}, further modify the current {current_understanding}."""
-        
-        refined_understanding = self.model.generate(prompt)
-        return refined_understanding
+        return TranslationPrompts.REFINEMENT.render(
+            source_language=source_lang,
+            target_language=target_lang,
+            sentence=source_sentence,
+            feedback=parts["feedback"],
+            understanding=parts["current_understanding"],
+        )
     
     def understanding_based_translation(self, source_sentence, source_understanding, target_understanding,direction):
-        prompt = self._create_translation_prompt(source_sentence, source_understanding, target_understanding,direction)
-        translation = self.model.generate(prompt)
-        return translation
+        return self._run(self.understanding_based_translation_async(
+            source_sentence, source_understanding, target_understanding, direction
+        ))
+    
+    async def understanding_based_translation_async(self, source_sentence, source_understanding, target_understanding, direction,
+                                                    example=None):
+        """
+        Asynchronous version of `understanding_based_translation`
+        
+        Args:
+            example: Optional translation memory match {"source", "translation", ...}
+                offered to the model as a reference
+        """
+        with metrics.stage("translation"):
+            prompt = self._create_translation_prompt(
+                source_sentence, source_understanding, target_understanding, direction, example=example
+            )
+            translation = await self._agenerate(prompt)
+            return translation
     
-    def _create_translation_prompt(self, source_sentence, source_understanding, target_understanding,direction):
+    def _create_translation_prompt(self, source_sentence, source_understanding, target_understanding,direction, example=None):
         source_lang, target_lang = direction.split("-")
         source_lang = Language.make(language=source_lang).display_name()
         target_lang = Language.make(language=target_lang).display_name()
+        parts = self._fit("translation", source_understanding=source_understanding, target_understanding=target_understanding)
+        example = example or {}
 
-        prompt = f"""Based on {source_understanding} and {target_understanding}, translate the following text in {target_lang} without any explanation.
+        return TranslationPrompts.TRANSLATION.render(
+            target_language=target_lang,
+            source_understanding=parts["source_understanding"],
+            target_understanding=parts["target_understanding"],
+            similar_text=example.get("source"),
+            similar_translation=example.get("translation"),
+            sentence=source_sentence,
+        )
+    
+    def translate(self, source_sentence,direction="zh-en", checkpoint=None):
+        return self._run(self.translate_async(source_sentence, direction, checkpoint=checkpoint))
+    
+    async def translate_async(self, source_sentence, direction="zh-en", checkpoint=None):
+        """
+        Translate a sentence
+        
+        Args:
+            source_sentence: Source language sentence
+            direction: Translation direction, e.g. "zh-en"
+            checkpoint: Optional stage checkpoint with get(stage) and put(stage, value);
+                stages already recorded in it are not recomputed
+            
+        Returns:
+            str: Translation
+        """
+        trace = metrics.new_trace(source_sentence, direction)
+        with metrics.tracing(trace):
+            translation = await self._translate_async(source_sentence, direction, checkpoint)
+        if self.trace_callback is not None:
+            self.trace_callback(trace)
+        return translation
+    
+    def translate_multi(self, source_sentence, targets, source_lang="en"):
+        return self._run(self.translate_multi_async(source_sentence, targets, source_lang=source_lang))
+    
+    async def translate_multi_async(self, source_sentence, targets, source_lang="en"):
+        """
+        Translate a sentence into several target languages
+        
+        The source understanding depends only on the source sentence and language, so
+        it is generated once and shared; the target understanding, refinement and
+        translation of every target run concurrently. The shared call is recorded in
+        the trace of the first target.
+        
+        Args:
+            source_sentence: Source language sentence
+            targets: Target language codes, e.g. ["es", "fr", "zh"]
+            source_lang: Source language code
+            
+        Returns:
+            dict: Target language code -> translation
+        """
+        directions = [f"{source_lang}-{target}" for target in targets]
+        shared = metrics.new_trace(source_sentence, directions[0])
+        with metrics.tracing(shared):
+            # Known source terms of every direction, without duplicates
+            known_terms = {}
+            for direction in directions:
+                for term, explanation in self._known_terms(source_sentence, direction)[0]:
+                    known_terms.setdefault(term.lower(), (term, explanation))
+            known_terms = list(known_terms.values())
+            if self.terminology is not None:
+                known_terms = known_terms[:self.terminology.max_terms_per_prompt]
+            with metrics.stage("understanding"):
+                source_understanding = await self._generate_source_understanding_async(
+                    source_sentence, Language.make(language=source_lang).display_name(), known_terms=known_terms
+                )
+        self.stats["shared_source_understandings"] += 1
+        
+        async def translate_target(direction, trace):
+            with metrics.tracing(trace):
+                translation = await self._translate_async(
+                    source_sentence, direction, None, source_understanding=source_understanding
+                )
+            if self.trace_callback is not None:
+                self.trace_callback(trace)
+            return translation
         
-        source_sentence: {source_sentence}
+        traces = [shared] + [metrics.new_trace(source_sentence, direction) for direction in directions[1:]]
+        translations = await asyncio.gather(*(
+            translate_target(direction, trace) for direction, trace in zip(directions, traces)
+        ))
+        return dict(zip(targets, translations))
+    
+    def _memory_lookup(self, source_sentence, direction):
         """
-        return prompt
+        Consult the translation memory
+        
+        Returns:
+            tuple: (exact translation or None, fuzzy match or None, refinement rounds to run)
+        """
+        if self.translation_memory is None:
+            return None, None, self.max_iterations
+        translation = self.translation_memory.exact(source_sentence, direction)
+        if translation is not None:
+            self.stats["memory_exact"] += 1
+            metrics.current_trace()["outcome"] = "memory"
+            logger.info("Translation memory exact match")
+            return translation, None, 0
+        match = self.translation_memory.fuzzy(source_sentence, direction)
+        if match is None:
+            return None, None, self.max_iterations
+        # A close match needs no refinement, a looser one a single round
+        self.stats["memory_fuzzy"] += 1
+        metrics.current_trace()["memory_similarity"] = match["similarity"]
+        skip = match["similarity"] >= self.translation_memory.skip_threshold
+        return None, match, 0 if skip else min(1, self.max_iterations)
+    
+    def _remember_translation(self, source_sentence, translation, direction):
+        if self.translation_memory is not None and not is_error(translation):
+            self.translation_memory.add(source_sentence, translation, direction)
     
-    def translate(self, source_sentence,direction="zh-en"):
+    async def _translate_async(self, source_sentence, direction, checkpoint, source_understanding=None):
+        # 0. Translation Memory
+        translation, match, max_iterations = self._memory_lookup(source_sentence, direction)
+        if translation is not None:
+            return translation
+        
         # 1. Understanding Generation
-        source_understanding, target_understanding = self.generate_understanding(source_sentence,direction)
-        print("understanding:", source_understanding)
-        print("target_understanding:", target_understanding)
-        print('1. Understanding generation completed')
+        saved = checkpoint.get("understanding") if checkpoint is not None else None
+        if saved:
+            source_understanding, target_understanding = saved
+        else:
+            source_understanding, target_understanding = await self.generate_understanding_async(
+                source_sentence, direction, source_understanding=source_understanding
+            )
+            # A failed understanding fails the sentence instead of being translated from
+            error = self._understanding_error(source_understanding, target_understanding)
+            if error is not None:
+                metrics.current_trace()["outcome"] = "understanding_error"
+                return error
+            if checkpoint is not None:
+                checkpoint.put("understanding", [source_understanding, target_understanding])
+        logger.debug("source understanding: %s", source_understanding)
+        logger.debug("target understanding: %s", target_understanding)
+        logger.info("1. Understanding generation completed")
         
         # 2 & 3. Alignment Judgment and Iterative Refinement
-        refined_source_understanding, refined_target_understanding = self.iterative_refinement(
-            source_sentence, source_understanding, target_understanding, direction
-        )
-        print('refined_source_understanding:', refined_source_understanding)
-        print('refined_target_understanding:', refined_target_understanding)
-        print('2 & 3. Alignment judgment and iterative refinement completed')
+        speculative_translation = None
+        saved = checkpoint.get("refinement") if checkpoint is not None else None
+        if saved:
+            refined_source_understanding, refined_target_understanding = saved
+        else:
+            initial_judgment = None
+            if self.speculative and max_iterations > 0:
+                initial_judgment, speculative_translation = await self._speculative_translation_async(
+                    source_sentence, source_understanding, target_understanding, direction, example=match
+                )
+            refined_source_understanding, refined_target_understanding = await self.iterative_refinement_async(
+                source_sentence, source_understanding, target_understanding, direction,
+                initial_judgment=initial_judgment, max_iterations=max_iterations,
+            )
+            if checkpoint is not None:
+                checkpoint.put("refinement", [refined_source_understanding, refined_target_understanding])
+        logger.debug("refined source understanding: %s", refined_source_understanding)
+        logger.debug("refined target understanding: %s", refined_target_understanding)
+        logger.info("2 & 3. Alignment judgment and iterative refinement completed")
         
         # 4. Understanding-Based Translation
-        translation = self.understanding_based_translation(
-            source_sentence, refined_source_understanding, refined_target_understanding,direction
+        if speculative_translation is not None:
+            translation = speculative_translation
+        else:
+            translation = await self.understanding_based_translation_async(
+                source_sentence, refined_source_understanding, refined_target_understanding,direction, example=match
+            )
+        logger.info("4. Understanding-based translation completed")
+        logger.debug("translation: %s", translation)
+        self._remember_translation(source_sentence, translation, direction)
+        return translation
+    
+    async def _speculative_translation_async(self, source_sentence, source_understanding, target_understanding, direction,
+                                             example=None):
+        """
+        Run the first alignment judgment and a translation from the initial understandings concurrently
+        
+        Returns:
+            tuple: (judgment result, translation if the understandings are aligned or the judgment
+                failed, so they are not refined, otherwise None)
+        """
+        self.stats["speculations"] += 1
+        speculation = asyncio.ensure_future(self.understanding_based_translation_async(
+            source_sentence, source_understanding, target_understanding, direction, example=example
+        ))
+        try:
+            judgment = await self.alignment_judgment_async(
+                source_sentence, source_understanding, target_understanding, direction
+            )
+        except BaseException:
+            speculation.cancel()
+            raise
+        
+        trace = metrics.current_trace()
+        # A failed judgment has no feedback, so the understandings are not refined either
+        if judgment[0] or judgment[1] is None:
+            self.stats["speculation_hits"] += 1
+            if trace is not None:
+                trace["speculation"] = "hit"
+            return judgment, await speculation
+        
+        # The understandings will be refined, so the speculative translation is discarded
+        speculation.cancel()
+        self.stats["speculation_wasted"] += 1
+        if trace is not None:
+            trace["speculation"] = "wasted"
+        return judgment, None
+    
+    async def _astream(self, prompt):
+        """
+        Stream the model's response to a prompt
+        
+        Models without an `astream` method produce the whole response as one chunk.
+        """
+        if getattr(self.model, "astream", None) is None:
+            yield await self._agenerate(prompt)
+            return
+        with metrics.llm_call() as call:
+            try:
+                async for chunk in self.model.astream(prompt):
+                    yield chunk
+            finally:
+                if not call["cache_hit"]:
+                    self.stats["llm_calls"] += 1
+    
+    def translate_stream(self, source_sentence, direction="zh-en"):
+        """
+        Translate a sentence, streaming status events and translation chunks
+        
+        Synchronous generator over `translate_stream_async`; see there for the events.
+        """
+        events = self.translate_stream_async(source_sentence, direction)
+        try:
+            while True:
+                try:
+                    yield self._run(_anext(events))
+                except StopAsyncIteration:
+                    break
+        finally:
+            self._run(_aclose(events))
+    
+    async def translate_stream_async(self, source_sentence, direction="zh-en"):
+        """
+        Translate a sentence, streaming status events and translation chunks
+        
+        The pipeline runs in its own task, so the per-sentence trace covers every
+        stage however slowly the events are consumed. The time from the start to
+        the first translation chunk is recorded in the trace as "time_to_first_token".
+        
+        Yields:
+            dict: {"type": "status", "stage", "elapsed"} when the understanding, refinement
+                and translation stages start (the translation status also carries the
+                refinement "iterations" and "outcome"), {"type": "chunk", "text"} for each
+                piece of the translation, and finally {"type": "done", "translation"}, or
+                {"type": "error", "error"} if the translation failed; the chunks sent
+                before an error are an incomplete translation
+        """
+        events = asyncio.Queue()
+        trace = metrics.new_trace(source_sentence, direction)
+        
+        async def run():
+            with metrics.tracing(trace):
+                await self._translate_stream_async(source_sentence, direction, events.put_nowait)
+        
+        task = asyncio.ensure_future(run())
+        task.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+            # Re-raise an exception of the pipeline
+            task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if self.trace_callback is not None:
+            self.trace_callback(trace)
+    
+    async def _translate_stream_async(self, source_sentence, direction, emit):
+        start = time.perf_counter()
+        trace = metrics.current_trace()
+        
+        def status(stage, **info):
+            emit({"type": "status", "stage": stage, "elapsed": time.perf_counter() - start, **info})
+        
+        translation, match, max_iterations = self._memory_lookup(source_sentence, direction)
+        if translation is not None:
+            trace["time_to_first_token"] = time.perf_counter() - start
+            emit({"type": "chunk", "text": translation})
+            emit({"type": "done", "translation": translation})
+            return
+        
+        status("understanding")
+        source_understanding, target_understanding = await self.generate_understanding_async(source_sentence, direction)
+        error = self._understanding_error(source_understanding, target_understanding)
+        if error is not None:
+            trace["outcome"] = "understanding_error"
+            emit({"type": "error", "error": error})
+            return
+        status("refinement")
+        source_understanding, target_understanding = await self.iterative_refinement_async(
+            source_sentence, source_understanding, target_understanding, direction, max_iterations=max_iterations
+        )
+        status("translation", iterations=trace["iterations"], outcome=trace["outcome"])
+        
+        prompt = self._create_translation_prompt(
+            source_sentence, source_understanding, target_understanding, direction, example=match
         )
-        print('4. Understanding-based translation completed')
-        print('translation:', translation)
-        return translation
\ No newline at end of file
+        chunks = []
+        error = None
+        with metrics.stage("translation"):
+            try:
+                async for chunk in self._astream(prompt):
+                    if not chunks and is_error(chunk):
+                        # A request that failed yields nothing else
+                        error = chunk
+                        continue
+                    if not chunks:
+                        trace["time_to_first_token"] = time.perf_counter() - start
+                    chunks.append(chunk)
+                    emit({"type": "chunk", "text": chunk})
+            except Exception as e:
+                error = f"Error: {e}"
+        if error is not None:
+            # The chunks sent so far are not a whole translation, so it is not remembered
+            emit({"type": "error", "error": error})
+            return
+        translation = "".join(chunks)
+        self._remember_translation(source_sentence, translation, direction)
+        emit({"type": "done", "translation": translation})
+    
+    def translate_document(self, text, direction="zh-en", max_in_flight=8,
+                           max_segment_chars=document.DEFAULT_MAX_SEGMENT_CHARS):
+        return self._run(self.translate_document_async(
+            text, direction, max_in_flight=max_in_flight, max_segment_chars=max_segment_chars
+        ))
+    
+    async def translate_document_async(self, text, direction="zh-en", max_in_flight=8,
+                                       max_segment_chars=document.DEFAULT_MAX_SEGMENT_CHARS):
+        """
+        Translate a multi-sentence document segment by segment
+        
+        The document is split into segments of whole sentences, keeping markup such as
+        ===Heading=== and * list items out of them. The source and target understandings
+        are generated and refined once for the whole document, and every segment is
+        then translated with them, up to `max_in_flight` segments at the same time.
+        
+        Args:
+            text: Source document
+            direction: Translation direction, e.g. "zh-en"
+            max_in_flight: Maximum number of segments being translated at the same time
+            max_segment_chars: Sentences are grouped into segments of up to this many characters
+            
+        Returns:
+            str: Translated document with the original markup
+        
+        Raises:
+            document.SegmentTranslationError: If segments could not be translated; it carries
+                their indices and errors, and the document with the other segments translated
+        """
+        parts = document.segment(text, max_segment_chars)
+        segments = [segment for kind, segment in parts if kind == "text"]
+        trace = metrics.new_trace(text, direction)
+        with metrics.tracing(trace):
+            trace["segments"] = len(segments)
+            context = document.plain_text(parts)
+            source_understanding, target_understanding = await self.generate_understanding_async(context, direction)
+            error = self._understanding_error(source_understanding, target_understanding)
+            if error is not None:
+                trace["outcome"] = "understanding_error"
+                translations = [error] * len(segments)
+            else:
+                source_understanding, target_understanding = await self.iterative_refinement_async(
+                    context, source_understanding, target_understanding, direction
+                )
+                
+                semaphore = asyncio.Semaphore(max_in_flight)
+                
+                async def translate_segment(segment):
+                    async with semaphore:
+                        return await self.understanding_based_translation_async(
+                            segment, source_understanding, target_understanding, direction
+                        )
+                
+                translations = await asyncio.gather(*(translate_segment(segment) for segment in segments))
+            failed = [index for index, translation in enumerate(translations) if is_error(translation)]
+            trace["failed_segments"] = len(failed)
+        if self.trace_callback is not None:
+            self.trace_callback(trace)
+        if failed:
+            # Failed segments stay in the source language rather than carrying error text
+            partial = None
+            if len(failed) < len(segments):
+                partial = document.reassemble(parts, [
+                    segment if is_error(translation) else translation
+                    for segment, translation in zip(segments, translations)
+                ])
+            raise document.SegmentTranslationError(failed, [translations[index] for index in failed], partial)
+        return document.reassemble(parts, translations)
+    
+    def translate_corpus(self, source_sentences, direction="zh-en", max_in_flight=8, progress_callback=None,
+                         checkpoint_factory=None):
+        """
+        Translate a corpus with up to `max_in_flight` sentences in flight
+        
+        Synchronous generator over `translate_corpus_async`; see there for the arguments.
+        
+        Yields:
+            tuple: (index, source sentence, translation) in input order
+        """
+        results = self.translate_corpus_async(
+            source_sentences, direction, max_in_flight=max_in_flight, progress_callback=progress_callback,
+            checkpoint_factory=checkpoint_factory,
+        )
+        try:
+            while True:
+                try:
+                    yield self._run(_anext(results))
+                except StopAsyncIteration:
+                    break
+        finally:
+            self._run(_aclose(results))
+    
+    async def translate_corpus_async(self, source_sentences, direction="zh-en", max_in_flight=8, progress_callback=None,
+                                     checkpoint_factory=None):
+        """
+        Translate a corpus with up to `max_in_flight` sentences in flight
+        
+        Args:
+            source_sentences: Iterable of source sentences, consumed lazily so generators are streamed
+            direction: Translation direction, e.g. "zh-en"
+            max_in_flight: Maximum number of sentences being translated at the same time
+            progress_callback: Optional callable(completed, index) invoked whenever a sentence finishes
+            checkpoint_factory: Optional callable(index, sentence) returning the stage checkpoint
+                passed to `translate_async` for that sentence
+            
+        Yields:
+            tuple: (index, source sentence, translation) in input order
+        """
+        sentences = enumerate(source_sentences)
+        running = {}
+        finished = {}
+        next_index = 0
+        completed = 0
+        exhausted = False
+        try:
+            while True:
+                # Keep the pipeline full, but never run too far ahead of the next sentence to yield
+                while not exhausted and len(running) < max_in_flight and len(running) + len(finished) < max_in_flight * CORPUS_REORDER_WINDOW:
+                    try:
+                        index, sentence = next(sentences)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    checkpoint = checkpoint_factory(index, sentence) if checkpoint_factory is not None else None
+                    task = asyncio.ensure_future(self.translate_async(sentence, direction, checkpoint=checkpoint))
+                    running[task] = (index, sentence)
+                
+                if not running and not finished:
+                    break
+                
+                if next_index not in finished:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        index, sentence = running.pop(task)
+                        finished[index] = (index, sentence, task.result())
+                        completed += 1
+                        if progress_callback is not None:
+                            progress_callback(completed, index)
+                
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+    
+    def translate_batch(self, source_sentences, direction="zh-en", directory="batches", processor=None):
+        """
+        Translate a corpus stage by stage through batch files
+        
+        Trades per-sentence latency for throughput and cost: see `batch.BatchRunner`.
+        
+        Args:
+            source_sentences: Iterable of source sentences
+            direction: Translation direction, e.g. "zh-en"
+            directory: Directory for the batch-request and output JSONL files
+            processor: Callable(input_path, output_path) processing a batch file, e.g.
+                `batch.OpenAIBatchProcessor`; defaults to sending the requests through this model
+            
+        Returns:
+            list: Translations in input order
+        """
+        from batch import BatchRunner
+        
+        return BatchRunner(self, directory, processor=processor).run(list(source_sentences), direction)
@@ -0,0 +1,242 @@
+# Metrics and Tracing
+import contextvars
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Per-sentence trace and pipeline stage of the translation in flight in the current task
+_current_trace = contextvars.ContextVar("ibut_trace", default=None)
+_current_stage = contextvars.ContextVar("ibut_stage", default=None)
+# LLM call in progress in the current task, told by `record_usage` whether it hit the response cache
+_current_call = contextvars.ContextVar("ibut_call", default=None)
+
+STAGE_FIELDS = ("wall_time", "llm_time", "calls", "prompt_tokens", "cached_tokens", "completion_tokens", "cache_hits")
+
+
+def new_trace(source_sentence, direction):
+    """
+    Empty per-sentence trace
+
+    Returns:
+        dict: Trace filled in by IBUT while the sentence is translated
+    """
+    return {
+        "source": source_sentence,
+        "direction": direction,
+        "wall_time": 0.0,
+        "iterations": 0,
+        "outcome": None,
+        "stages": {},
+        "convergence": [],
+    }
+
+
+def current_trace():
+    """Trace of the sentence being translated in the current task, or None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def tracing(trace):
+    """Make `trace` the current trace and time the block as the sentence's wall time"""
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace["wall_time"] += time.perf_counter() - start
+        _current_trace.reset(token)
+
+
+def _stage_entry(trace, stage):
+    entry = trace["stages"].get(stage)
+    if entry is None:
+        entry = trace["stages"][stage] = dict.fromkeys(STAGE_FIELDS, 0)
+    return entry
+
+
+@contextmanager
+def stage(name):
+    """Attribute the block's wall time, and the LLM calls made in it, to a pipeline stage"""
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        trace = _current_trace.get()
+        if trace is not None:
+            _stage_entry(trace, name)["wall_time"] += time.perf_counter() - start
+
+
+def record_call(latency):
+    """Record one LLM call of the current stage"""
+    trace = _current_trace.get()
+    if trace is not None:
+        entry = _stage_entry(trace, _current_stage.get() or "other")
+        entry["calls"] += 1
+        entry["llm_time"] += latency
+
+
+@contextmanager
+def llm_call():
+    """
+    Time the block as one LLM call of the current stage
+
+    A call answered from the response cache is not counted as a call; it is
+    recorded as a cache hit by the model instead.
+
+    Yields:
+        dict: {"cache_hit"}, True once the model has reported a cache hit
+    """
+    call = {"cache_hit": False}
+    token = _current_call.set(call)
+    start = time.perf_counter()
+    try:
+        yield call
+    finally:
+        _current_call.reset(token)
+        if not call["cache_hit"]:
+            record_call(time.perf_counter() - start)
+
+
+def record_usage(prompt_tokens=0, completion_tokens=0, cache_hit=False, cached_tokens=0):
+    """
+    Record the token usage reported for an LLM call of the current stage
+
+    Args:
+        cached_tokens: Prompt tokens the provider served from its prompt prefix cache
+    """
+    call = _current_call.get()
+    if call is not None and cache_hit:
+        call["cache_hit"] = True
+    trace = _current_trace.get()
+    if trace is not None:
+        entry = _stage_entry(trace, _current_stage.get() or "other")
+        entry["prompt_tokens"] += prompt_tokens or 0
+        entry["cached_tokens"] += cached_tokens or 0
+        entry["completion_tokens"] += completion_tokens or 0
+        entry["cache_hits"] += int(cache_hit)
+
+
+class Metrics:
+    """
+    Collector of per-sentence traces
+
+    Pass an instance as `IBUT(trace_callback=...)`. Traces can be exported as
+    JSONL, and the aggregates as Prometheus text.
+    """
+
+    def __init__(self, path=None, keep_records=True):
+        """
+        Initialize collector
+
+        Args:
+            path: Optional JSONL file each trace is appended to as it arrives
+            keep_records: Keep every trace in memory for `write_jsonl`
+        """
+        self.path = path
+        self.keep_records = keep_records
+        self.records = []
+        self.sentences = 0
+        self.wall_time = 0.0
+        self.iterations = 0
+        self.outcomes = Counter()
+        self.stages = defaultdict(Counter)
+        self.first_tokens = 0
+        self.first_token_time = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, trace):
+        self.add(trace)
+
+    def add(self, trace):
+        """Aggregate a finished sentence trace"""
+        with self._lock:
+            self.sentences += 1
+            self.wall_time += trace["wall_time"]
+            self.iterations += trace["iterations"]
+            self.outcomes[trace["outcome"]] += 1
+            for name, entry in trace["stages"].items():
+                self.stages[name].update(entry)
+            if trace.get("time_to_first_token") is not None:
+                # Only streamed translations have a first token
+                self.first_tokens += 1
+                self.first_token_time += trace["time_to_first_token"]
+            if self.keep_records:
+                self.records.append(trace)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        """
+        Aggregated metrics
+
+        Returns:
+            dict: Totals over all sentences and per stage
+        """
+        with self._lock:
+            return {
+                "sentences": self.sentences,
+                "wall_time": self.wall_time,
+                "iterations": self.iterations,
+                "outcomes": dict(self.outcomes),
+                "stages": {name: dict(entry) for name, entry in self.stages.items()},
+                "calls_per_sentence": (
+                    sum(entry["calls"] for entry in self.stages.values()) / self.sentences if self.sentences else 0.0
+                ),
+                "streamed": self.first_tokens,
+                "first_token_seconds": self.first_token_time,
+                "mean_time_to_first_token": self.first_token_time / self.first_tokens if self.first_tokens else 0.0,
+            }
+
+    def write_jsonl(self, path):
+        """Write the kept traces, one JSON object per line"""
+        with self._lock, open(path, "w", encoding="utf-8") as file:
+            for trace in self.records:
+                file.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+    def to_prometheus(self, prefix="ibut"):
+        """
+        Aggregates in the Prometheus text exposition format
+
+        Returns:
+            str: Exposition text
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = "{" + ",".join(f'{key}="{val}"' for key, val in labels.items()) + "}" if labels else ""
+                lines.append(f"{prefix}_{name}{label_text} {value}")
+
+        metric("sentences_total", "counter", "Sentences translated", [({}, summary["sentences"])])
+        metric("sentence_seconds_total", "counter", "Wall time spent translating sentences", [({}, summary["wall_time"])])
+        metric("iterations_total", "counter", "Alignment judgment rounds", [({}, summary["iterations"])])
+        metric("outcomes_total", "counter", "How refinement ended",
+               [({"outcome": outcome}, count) for outcome, count in summary["outcomes"].items()])
+        metric("streamed_sentences_total", "counter", "Sentences whose translation was streamed", [({}, summary["streamed"])])
+        metric("first_token_seconds_total", "counter", "Time to the first translation chunk of streamed sentences",
+               [({}, summary["first_token_seconds"])])
+        stages = summary["stages"]
+        metric("stage_seconds_total", "counter", "Wall time per pipeline stage",
+               [({"stage": name}, entry["wall_time"]) for name, entry in stages.items()])
+        metric("llm_seconds_total", "counter", "Time spent waiting for LLM calls per pipeline stage",
+               [({"stage": name}, entry["llm_time"]) for name, entry in stages.items()])
+        metric("llm_calls_total", "counter", "LLM calls per pipeline stage",
+               [({"stage": name}, entry["calls"]) for name, entry in stages.items()])
+        metric("prompt_tokens_total", "counter", "Prompt tokens per pipeline stage",
+               [({"stage": name}, entry["prompt_tokens"]) for name, entry in stages.items()])
+        metric("cached_prompt_tokens_total", "counter", "Prompt tokens served from the provider's prompt cache per pipeline stage",
+               [({"stage": name}, entry["cached_tokens"]) for name, entry in stages.items()])
+        metric("completion_tokens_total", "counter", "Completion tokens per pipeline stage",
+               [({"stage": name}, entry["completion_tokens"]) for name, entry in stages.items()])
+        metric("cache_hits_total", "counter", "Responses served from the response cache per pipeline stage",
+               [({"stage": name}, entry["cache_hits"]) for name, entry in stages.items()])
+        return "\n".join(lines) + "\n"
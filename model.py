@@ -1,4 +1,27 @@
 # Model Interface
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import weakref
+from collections import Counter
+from types import SimpleNamespace
+
+import metrics
+from budget import estimate_tokens
+from prompts import TranslationPrompts
+from ratelimit import RetryPolicy, is_retryable, retry_after_seconds
+
+DEFAULT_BASE_URL = "https://api.deepseek.com"
+DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant specializing in language understanding and translation."
+
+logger = logging.getLogger(__name__)
+
 
 class LLMModel:
     """
@@ -9,16 +32,140 @@ class LLMModel:
     For example, it can implement different interfaces like OpenAI, Anthropic, local models, etc.
     """
     
-    def __init__(self, model_name="gpt-3.5-turbo", api_key=None):
+    def __init__(self, model_name="gpt-3.5-turbo", api_key=None, base_url=DEFAULT_BASE_URL,
+                 timeout=60.0, connect_timeout=10.0, max_connections=64,
+                 max_keepalive_connections=16, keepalive_expiry=30.0,
+                 system_message=DEFAULT_SYSTEM_MESSAGE, temperature=1.3, cache=None,
+                 rate_limiter=None, retry_policy=None):
         """
         Initialize model interface
         
         Args:
             model_name: Model name
             api_key: API key (if needed)
+            base_url: API endpoint, e.g. a local stand-in server; None uses the OpenAI default
+            timeout: Per-request timeout in seconds
+            connect_timeout: Connection establishment timeout in seconds
+            max_connections: Size of the HTTP connection pool
+            max_keepalive_connections: Idle connections kept open for reuse
+            keepalive_expiry: Seconds an idle connection is kept alive
+            system_message: System message sent with every prompt
+            temperature: Sampling temperature
+            cache: Optional ResponseCache consulted before calling the API
+            rate_limiter: Optional RateLimiter, usually shared per model via `get_rate_limiter`
+            retry_policy: RetryPolicy for transient errors such as 429s and timeouts
         """
         self.model_name = model_name
         self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.system_message = system_message
+        self.temperature = temperature
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        
+        # Clients are created lazily and reused by every call; async clients are
+        # bound to the event loop that created them, so keep one per loop
+        self._client_lock = threading.Lock()
+        self._sync_client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+    
+    def _http_options(self):
+        """Connection pool and timeout settings shared by the sync and async clients"""
+        try:
+            import httpx
+        except ImportError:  # newer openai releases are built on httpx2
+            import httpx2 as httpx
+        
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            "timeout": httpx.Timeout(self.timeout, connect=self.connect_timeout),
+        }
+    
+    def _client(self):
+        """Return the shared synchronous client, creating it on first use"""
+        if self._sync_client is None:
+            with self._client_lock:
+                if self._sync_client is None:
+                    from openai import OpenAI, DefaultHttpxClient
+                    
+                    self._sync_client = OpenAI(
+                        api_key=self.api_key,
+                        base_url=self.base_url,
+                        # Retries are handled by `retry_policy`
+                        max_retries=0,
+                        http_client=DefaultHttpxClient(**self._http_options()),
+                    )
+        return self._sync_client
+    
+    def _async_client(self):
+        """Return the asynchronous client of the running event loop, creating it on first use"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            with self._client_lock:
+                client = self._async_clients.get(loop)
+                if client is None:
+                    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                    
+                    client = AsyncOpenAI(
+                        api_key=self.api_key,
+                        base_url=self.base_url,
+                        max_retries=0,
+                        http_client=DefaultAsyncHttpxClient(**self._http_options()),
+                    )
+                    self._async_clients[loop] = client
+        return client
+    
+    def close(self):
+        """Close the pooled synchronous client"""
+        with self._client_lock:
+            client, self._sync_client = self._sync_client, None
+        if client is not None:
+            client.close()
+    
+    async def aclose(self):
+        """Close the pooled asynchronous client of the running event loop"""
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+    
+    def _messages(self, prompt):
+        """Build the chat messages for a prompt"""
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _cache_key(self, prompt):
+        """Cache key of a prompt under the current model settings"""
+        from cache import ResponseCache
+        
+        return ResponseCache.make_key(self.model_name, self.system_message, self.temperature, prompt)
+    
+    def _cache_get(self, cache_key):
+        """Cached response, or None; a failing cache read counts as a miss"""
+        try:
+            return self.cache.get(cache_key)
+        except Exception as e:
+            logger.warning("Response cache read failed, treating as a miss: %s", e)
+            return None
+    
+    def _cache_put(self, cache_key, content):
+        """Cache a response; a failing cache write is skipped so the response is not lost"""
+        try:
+            self.cache.put(cache_key, content)
+        except Exception as e:
+            logger.warning("Response cache write failed, not caching the response: %s", e)
     
     def generate(self, prompt):
         """
@@ -30,37 +177,191 @@ class LLMModel:
         Returns:
             str: Generated text
         """
-        import openai
-        from openai import OpenAI
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                metrics.record_usage(cache_hit=True)
+                return cached
         
         # customize any LLM implementation here
-        client = OpenAI(api_key=self.api_key, base_url="https://api.deepseek.com")
-        # client = OpenAI(
-        #         # This is the default and can be omitted
-        #         api_key = self.api_key
-        #     )
-        print(f"\n[Model name] model: {self.model_name}\Prompt: {prompt[:100]}...")
+        logger.debug("[Model name] model: %s Prompt: %s...", self.model_name, prompt[:100])
         
         try:
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant specializing in language understanding and translation."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=1.3,
-            )
+            content = self._complete(prompt)
+        except Exception as e:
+            logger.warning("OpenAI API call error: %s", e)
+            return f"Error: {str(e)}"
+        if self.cache is not None:
+            self._cache_put(cache_key, content)
+        return content
+    
+    def _complete(self, prompt):
+        """Call the API under the rate limiter, retrying transient errors"""
+        reserved = self.rate_limiter.estimate(prompt) if self.rate_limiter is not None else 0
+        for attempt in range(self.retry_policy.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(reserved)
+            try:
+                response = self._create(prompt)
+            except Exception as error:
+                if attempt == self.retry_policy.max_retries or not is_retryable(error):
+                    raise
+                time.sleep(self._backoff(attempt, error))
+                continue
+            self._settle(reserved, response)
             return response.choices[0].message.content
+    
+    def _create(self, prompt):
+        """Send one chat completion request"""
+        return self._client().chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt),
+            temperature=self.temperature,
+        )
+    
+    async def _acreate(self, prompt):
+        """Send one chat completion request asynchronously"""
+        return await self._async_client().chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt),
+            temperature=self.temperature,
+        )
+    
+    def _backoff(self, attempt, error):
+        """Seconds to wait before retrying; a Retry-After also holds back other callers of the limiter"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None and self.rate_limiter is not None:
+            self.rate_limiter.pause(retry_after)
+        return self.retry_policy.delay(attempt, retry_after)
+    
+    def _settle(self, reserved, response):
+        """Record the reported token usage and settle the rate limiter's reservation against it"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        metrics.record_usage(usage.prompt_tokens, usage.completion_tokens, cached_tokens=cached_prompt_tokens(usage))
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(reserved, usage.total_tokens)
+    
+    async def agenerate(self, prompt):
+        """
+        Generate text asynchronously
+        
+        Args:
+            prompt: Prompt text
+            
+        Returns:
+            str: Generated text
+        """
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                metrics.record_usage(cache_hit=True)
+                return cached
+        
+        logger.debug("[Model name] model: %s Prompt: %s...", self.model_name, prompt[:100])
+        
+        try:
+            content = await self._acomplete(prompt)
         except Exception as e:
-            print(f"OpenAI API call error: {str(e)}")
+            logger.warning("OpenAI API call error: %s", e)
             return f"Error: {str(e)}"
+        if self.cache is not None:
+            self._cache_put(cache_key, content)
+        return content
+    
+    async def _acomplete(self, prompt):
+        """Asynchronous version of `_complete`"""
+        reserved = self.rate_limiter.estimate(prompt) if self.rate_limiter is not None else 0
+        for attempt in range(self.retry_policy.max_retries + 1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(reserved)
+            try:
+                response = await self._acreate(prompt)
+            except Exception as error:
+                if attempt == self.retry_policy.max_retries or not is_retryable(error):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, error))
+                continue
+            self._settle(reserved, response)
+            return response.choices[0].message.content
+    
+    async def astream(self, prompt):
+        """
+        Generate text asynchronously, yielding it in chunks as it arrives
+        
+        Transient errors are retried until the stream is open. A request that still
+        fails yields a single "Error: ..." chunk, the text `agenerate` would return.
+        Only complete responses are cached.
+        
+        Args:
+            prompt: Prompt text
+            
+        Yields:
+            str: Pieces of the generated text
+        
+        Raises:
+            Exception: The error of a stream that breaks off after its first chunk,
+                whose text so far is incomplete
+        """
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                metrics.record_usage(cache_hit=True)
+                yield cached
+                return
+        
+        logger.debug("[Model name] model: %s Prompt: %s...", self.model_name, prompt[:100])
+        
+        reserved = self.rate_limiter.estimate(prompt) if self.rate_limiter is not None else 0
+        parts = []
+        try:
+            stream = await self._aopen_stream(prompt, reserved)
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    self._settle(reserved, chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logger.warning("OpenAI API call error: %s", e)
+            if parts:
+                raise
+            yield f"Error: {str(e)}"
+            return
+        if self.cache is not None:
+            self._cache_put(cache_key, "".join(parts))
+    
+    async def _aopen_stream(self, prompt, reserved):
+        """Open a streaming request under the rate limiter, retrying transient errors"""
+        for attempt in range(self.retry_policy.max_retries + 1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(reserved)
+            try:
+                return await self._acreate_stream(prompt)
+            except Exception as error:
+                if attempt == self.retry_policy.max_retries or not is_retryable(error):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, error))
+    
+    async def _acreate_stream(self, prompt):
+        """Send one streaming chat completion request; the last chunk carries the token usage"""
+        return await self._async_client().chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt),
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
     
     def _extract_sentence(self, prompt):
         """Extract sentence from prompt"""
-        if "Sentence:" in prompt:
-            parts = prompt.split("Sentence: ")
-            if len(parts) > 1:
-                sentence_part = parts[1].split("\n")[0].strip()
+        for label in ("Source sentence: ", "Sentence: ", "source_sentence: "):
+            if label in prompt:
+                sentence_part = prompt.split(label, 1)[1].split("\n")[0].strip()
                 return sentence_part
         return ""
     
@@ -142,7 +443,7 @@ Target Language Feedback: Target language understanding of 'Carbon Neutrality' i
     
     def _mock_refined_understanding(self, prompt):
         """Mock refined understanding"""
-        if "source language" in prompt.lower():
+        if "source language" in prompt.split("Current understanding", 1)[-1].lower():
             return """Key Concepts:
 1. [Refined Source Language Key Concept 1]
 2. [Refined Source Language Key Concept 2]
@@ -182,3 +483,235 @@ Related Examples:
             return "Climate change is one of the most serious challenges facing humanity today. We need to take immediate action to reduce greenhouse gas emissions and achieve carbon neutrality."
         else:
             return "[Translation Result]"
+
+
+# Prompt types recognised by OfflineLLMModel and the template each is rendered from
+PROMPT_TEMPLATES = {
+    "fused_understanding": TranslationPrompts.FUSED_UNDERSTANDING,
+    "fused_judgment": TranslationPrompts.FUSED_ALIGNMENT_JUDGMENT,
+    "judgment": TranslationPrompts.ALIGNMENT_JUDGMENT,
+    "feedback": TranslationPrompts.FEEDBACK,
+    "refinement": TranslationPrompts.REFINEMENT,
+    "translation": TranslationPrompts.TRANSLATION,
+    "understanding": TranslationPrompts.UNDERSTANDING,
+}
+
+# Prompt types with the first instruction line their prompts start with
+PROMPT_TYPES = tuple((prompt_type, template.marker) for prompt_type, template in PROMPT_TEMPLATES.items())
+
+
+def classify_prompt(prompt):
+    """
+    Pipeline prompt type of a prompt
+    
+    Returns:
+        str: One of the PROMPT_TYPES names, or "other"
+    """
+    for prompt_type, marker in PROMPT_TYPES:
+        if prompt.startswith(marker):
+            return prompt_type
+    return "other"
+
+
+def cached_prompt_tokens(usage):
+    """
+    Prompt tokens the provider served from its prompt prefix cache
+    
+    Reads `prompt_tokens_details.cached_tokens` (OpenAI) or `prompt_cache_hit_tokens`
+    (DeepSeek) from a usage object or dict.
+    
+    Returns:
+        int: Cached prompt tokens, 0 if none are reported
+    """
+    def get(value, key):
+        return value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    
+    details = get(usage, "prompt_tokens_details")
+    cached = get(details, "cached_tokens") if details is not None else None
+    if cached is None:
+        cached = get(usage, "prompt_cache_hit_tokens")
+    return cached or 0
+
+
+def uniform_latency(low, high):
+    """Latency drawn uniformly from [low, high] seconds"""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5):
+    """Log-normally distributed latency with the given median in seconds"""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+class SimulatedAPIError(Exception):
+    """Error injected by OfflineLLMModel, retryable like a provider 5xx"""
+    
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OfflineLLMModel(LLMModel):
+    """
+    Deterministic offline LLM backend
+    
+    Answers every pipeline prompt with the mock responders instead of calling an
+    API, after a simulated latency. Errors, timeouts and the judge's alignment
+    verdict are drawn from a random generator seeded with `seed` and the prompt,
+    so runs are reproducible regardless of scheduling. Responses go through the
+    same cache, rate limiter, retry and metrics paths as real API calls.
+    
+    Provider-side prompt caching is simulated as well: once a template's system
+    message and instructions have been sent, later prompts of that template report
+    them as cached prompt tokens.
+    """
+    
+    def __init__(self, model_name="offline", latency=0.0, error_rate=0.0, timeout_rate=0.0,
+                 alignment_pass_rate=0.5, seed=0, **kwargs):
+        """
+        Initialize offline backend
+        
+        Args:
+            model_name: Model name, used for cache keys and rate limiter sharing
+            latency: Seconds per call, a callable(rng) -> seconds such as `lognormal_latency(0.8)`,
+                or a dict of prompt type -> either of those with an optional "default" entry
+            error_rate: Probability that a call fails with a retryable SimulatedAPIError
+            timeout_rate: Probability that a call hangs for `timeout` seconds and then times out
+            alignment_pass_rate: Probability that the judge finds the understandings aligned
+            seed: Seed of the random generator
+            **kwargs: Further LLMModel arguments, e.g. cache, rate_limiter, retry_policy, timeout
+        """
+        super().__init__(model_name=model_name, **kwargs)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.alignment_pass_rate = alignment_pass_rate
+        self.seed = seed
+        self.calls = Counter()
+        # Attempts per prompt, keyed by a short digest so long load tests do not keep every prompt alive
+        self._attempts = Counter()
+        self._prefixes = set()
+        self._lock = threading.Lock()
+    
+    def _rng(self, prompt):
+        """Random generator of one attempt at a prompt, independent of call order"""
+        key = hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest()
+        with self._lock:
+            attempt = self._attempts[key]
+            self._attempts[key] += 1
+        return random.Random(f"{self.seed}:{attempt}:{prompt}")
+    
+    def _latency(self, prompt_type, rng):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(prompt_type, latency.get("default", 0.0))
+        return latency(rng) if callable(latency) else latency
+    
+    def _plan(self, prompt):
+        """
+        Decide the outcome of one call
+        
+        Returns:
+            tuple: (seconds to wait, exception to raise or None, response text)
+        """
+        prompt_type = classify_prompt(prompt)
+        with self._lock:
+            self.calls[prompt_type] += 1
+        rng = self._rng(prompt)
+        if rng.random() < self.timeout_rate:
+            return self.timeout, TimeoutError("Simulated request timeout"), None
+        latency = self._latency(prompt_type, rng)
+        if rng.random() < self.error_rate:
+            return latency, SimulatedAPIError("Simulated server error"), None
+        return latency, None, self._respond(prompt_type, prompt, rng)
+    
+    def _respond(self, prompt_type, prompt, rng):
+        """Mock response to a prompt of the given type"""
+        if prompt_type == "fused_understanding":
+            return self._omit_known_terms(prompt, "[SOURCE UNDERSTANDING]\n" + self._mock_source_understanding(prompt)
+                                          + "\n[TARGET UNDERSTANDING]\n" + self._mock_target_understanding(prompt))
+        if prompt_type == "understanding":
+            return self._omit_known_terms(prompt, self._mock_source_understanding(prompt))
+        if prompt_type in ("judgment", "fused_judgment"):
+            aligned = rng.random() < self.alignment_pass_rate
+            if prompt_type == "fused_judgment":
+                feedback = "" if aligned else "Explain 'Carbon Neutrality' in more detail."
+                return json.dumps({"aligned": aligned, "source_feedback": feedback, "target_feedback": feedback})
+            # The separate judge answers "True" when the understandings differ
+            return "False" if aligned else "True\n" + self._mock_alignment_judgment(prompt)
+        if prompt_type == "feedback":
+            return "The understanding lacks an explanation of 'Carbon Neutrality', suggest adding it."
+        if prompt_type == "refinement":
+            return self._mock_refined_understanding(prompt)
+        if prompt_type == "translation":
+            return self._mock_translation(prompt)
+        return "[Response]"
+    
+    def _omit_known_terms(self, prompt, understanding):
+        """Shorten the explanations of terms listed as known in the prompt, as a model following it would"""
+        known = re.findall(r"^- (.+?): ", prompt.split("Known terms", 1)[1], re.MULTILINE) if "Known terms" in prompt else []
+        for term in known:
+            understanding = re.sub(
+                rf"^(\s*\d+\. {re.escape(term)}) - .*$", r"\1 (known term)", understanding, flags=re.MULTILINE
+            )
+        return understanding
+    
+    def _cached_tokens(self, prompt):
+        """Prompt tokens of the stable prefix if an earlier prompt already sent it"""
+        template = PROMPT_TEMPLATES.get(classify_prompt(prompt))
+        if template is None:
+            return 0
+        prefix = self.system_message + template.instructions
+        with self._lock:
+            if prefix not in self._prefixes:
+                self._prefixes.add(prefix)
+                return 0
+        # Prompt token counts cover the user message only, so only its share of the prefix is counted
+        return estimate_tokens(template.instructions)
+    
+    def _response(self, prompt, text):
+        """Chat completion response object carrying `text`"""
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=SimpleNamespace(
+                prompt_tokens=estimate_tokens(prompt),
+                completion_tokens=estimate_tokens(text),
+                total_tokens=estimate_tokens(prompt) + estimate_tokens(text),
+                prompt_tokens_details=SimpleNamespace(cached_tokens=self._cached_tokens(prompt)),
+            ),
+        )
+    
+    def _create(self, prompt):
+        latency, error, text = self._plan(prompt)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return self._response(prompt, text)
+    
+    async def _acreate(self, prompt):
+        latency, error, text = self._plan(prompt)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return self._response(prompt, text)
+    
+    async def _acreate_stream(self, prompt):
+        """
+        Streaming version of `_acreate`
+        
+        Half of the simulated latency passes before the stream opens (or the error
+        is raised); the other half is spread over the chunks, one per word.
+        """
+        latency, error, text = self._plan(prompt)
+        await asyncio.sleep(latency / 2)
+        if error is not None:
+            raise error
+        
+        async def chunks():
+            pieces = re.findall(r"\S+\s*|\s+", text) or [text]
+            for piece in pieces:
+                await asyncio.sleep(latency / 2 / len(pieces))
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+            yield SimpleNamespace(choices=[], usage=self._response(prompt, text).usage)
+        
+        return chunks()
@@ -1,91 +1,190 @@
 # Prompt Templates
+import hashlib
+
+
+class PromptTemplate:
+    """
+    Prompt with a fixed instruction prefix and variable fields at the end
+
+    Every prompt of a template starts with the same instructions, so together with
+    the system message they form a stable prefix that provider-side prompt caching
+    can reuse across calls. The variable content follows as labelled fields, in a
+    fixed order; empty fields are left out and lists are rendered as bullets.
+    """
+
+    def __init__(self, name, instructions, fields):
+        """
+        Args:
+            name: Registry name of the template
+            instructions: Fixed instructions; they must not contain variable content
+            fields: (argument name, label) pairs of the variable fields, in prompt order
+        """
+        self.name = name
+        self.instructions = instructions.strip()
+        self.fields = tuple(fields)
+        self.version = hashlib.sha256(
+            "\n".join([self.instructions] + [f"{key}={label}" for key, label in self.fields]).encode("utf-8")
+        ).hexdigest()[:12]
+
+    @property
+    def marker(self):
+        """First line of the instructions, which identifies prompts of this template"""
+        return self.instructions.split("\n", 1)[0]
+
+    def render(self, **values):
+        """
+        Fill in the variable fields
+
+        Args:
+            **values: Field values, either strings or lists of items
+
+        Returns:
+            str: The instructions followed by one "Label: value" block per non-empty field
+        """
+        unknown = set(values) - {key for key, _ in self.fields}
+        if unknown:
+            raise KeyError(f"{self.name} has no fields {sorted(unknown)}")
+        blocks = [self.instructions]
+        for key, label in self.fields:
+            value = values.get(key)
+            if not value:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = "\n".join(f"- {item}" for item in value)
+                blocks.append(f"{label}:\n{value}")
+                continue
+            value = str(value)
+            blocks.append(f"{label}:\n{value}" if "\n" in value else f"{label}: {value}")
+        return "\n\n".join(blocks)
+
 
 class TranslationPrompts:
-    """Translation-related prompt templates"""
-    
-    # Source language understanding prompt
-    SOURCE_UNDERSTANDING = """
-Please analyze the contextual understanding of the following sentence in the source language.
-
-Sentence: {sentence}
-
-Please provide the following information:
-1. Key concepts and their explanations
-2. Important terms and their definitions
-3. Detailed explanation of terms
-4. Related examples
-
-Note: Please ensure the analysis is comprehensive and accurate.
-"""
-    
-    # Target language understanding prompt
-    TARGET_UNDERSTANDING = """
-Please analyze the contextual understanding of the following sentence in the target language (English).
-
-Sentence: {sentence}
-
-Please provide the following information:
-1. Key concepts and their explanations
-2. Important terms and their definitions
-3. Detailed explanation of terms
-4. Related examples
-
-Note: Please ensure the analysis is comprehensive and accurate.
-"""
-    
-    # Alignment judgment prompt
-    ALIGNMENT_JUDGMENT = """
-Please evaluate the consistency between the following bilingual contextual understandings:
-
-Source language understanding:
-{source_understanding}
-
-Target language understanding:
-{target_understanding}
-
-Please provide:
-1. Consistency judgment (True/False)
-2. Areas for improvement in source language understanding (if any)
-3. Areas for improvement in target language understanding (if any)
-"""
-    
-    # Refine source understanding prompt
-    REFINE_SOURCE = """
-Please optimize the source language understanding based on the following feedback:
-
-Original understanding:
-{original_understanding}
-
-Feedback:
-{feedback}
-
-Please provide the complete refined understanding.
-"""
-    
-    # Refine target understanding prompt
-    REFINE_TARGET = """
-Please optimize the target language understanding based on the following feedback:
-
-Original understanding:
-{original_understanding}
-
-Feedback:
-{feedback}
-
-Please provide the complete refined understanding.
-"""
-    
-    # Translation prompt
-    TRANSLATION = """
-Please translate this sentence based on the following bilingual contextual understanding:
-
-Sentence: {sentence}
-
-Source language understanding:
-{source_understanding}
-
-Target language understanding:
-{target_understanding}
-
-Please provide accurate English translation.
-"""
\ No newline at end of file
+    """Translation-related prompt templates used by every IBUT stage"""
+
+    # Source or target language understanding, written in `language`
+    UNDERSTANDING = PromptTemplate(
+        "understanding",
+        """
+Please fully understand the meaning of the source sentence below and describe your understanding of key concepts, definitions, examples, and explanations of specific terms related to the translation task, written in the given language.
+If known terms are listed, they were already explained earlier: do not explain them again, refer to them briefly.
+""",
+        [("language", "Language"), ("known_terms", "Known terms"), ("sentence", "Source sentence")],
+    )
+
+    # Source and target language understanding in one response
+    FUSED_UNDERSTANDING = PromptTemplate(
+        "fused_understanding",
+        """
+Please fully understand the meaning of the source sentence below, once in the source language and once in the target language.
+Describe your understanding of key concepts, definitions, examples, and explanations of specific terms related to the task of translating it into the target language.
+If known terms are listed, they were already explained earlier: do not explain them again, refer to them briefly.
+
+Use exactly this layout:
+[SOURCE UNDERSTANDING]
+(your understanding, written in the source language)
+[TARGET UNDERSTANDING]
+(your understanding, written in the target language)
+""",
+        [
+            ("source_language", "Source language"),
+            ("target_language", "Target language"),
+            ("known_terms", "Known terms"),
+            ("sentence", "Source sentence"),
+        ],
+    )
+
+    # Alignment judgment; answers "True" when the understandings differ
+    ALIGNMENT_JUDGMENT = PromptTemplate(
+        "alignment_judgment",
+        """
+If you are a linguist of the source and target languages below, determine whether the source contextual understanding and the target contextual understanding, based on the source sentence, convey different key concepts, definitions, examples, and explanations of specific terms related to the translation task.
+If so, provide a "True" response; otherwise, give a "False" response.
+""",
+        [
+            ("source_language", "Source language"),
+            ("target_language", "Target language"),
+            ("sentence", "Source sentence"),
+            ("source_understanding", "Source contextual understanding"),
+            ("target_understanding", "Target contextual understanding"),
+        ],
+    )
+
+    # Feedback on one understanding after a misaligned judgment
+    FEEDBACK = PromptTemplate(
+        "feedback",
+        """
+If you are a linguist of the language below, based on the core meaning of the source sentence, analyze the alignment judgment.
+Generate verbal feedback in that language to correct any current errors in the contextual understanding.
+""",
+        [
+            ("language", "Language"),
+            ("sentence", "Source sentence"),
+            ("judgment", "Alignment judgment"),
+            ("understanding", "Contextual understanding"),
+        ],
+    )
+
+    # Alignment judgment returning the verdict and both feedbacks in one response
+    FUSED_ALIGNMENT_JUDGMENT = PromptTemplate(
+        "fused_alignment_judgment",
+        """
+If you are a linguist of the source and target languages below, evaluate whether the bilingual contextual understandings of the source sentence convey the same key concepts, definitions, examples, and explanations of specific terms related to the translation task.
+Respond with a single JSON object and nothing else:
+{"aligned": true or false, "source_feedback": "feedback in the source language correcting the source language understanding, empty if aligned", "target_feedback": "feedback in the target language correcting the target language understanding, empty if aligned"}
+""",
+        [
+            ("source_language", "Source language"),
+            ("target_language", "Target language"),
+            ("sentence", "Source sentence"),
+            ("source_understanding", "Source language understanding"),
+            ("target_understanding", "Target language understanding"),
+        ],
+    )
+
+    # Refinement of one understanding based on feedback
+    REFINEMENT = PromptTemplate(
+        "refinement",
+        """
+If you are a linguist proficient in both the source and target languages below, based on the core meaning of the source sentence and the feedback, further modify the current understanding.
+""",
+        [
+            ("source_language", "Source language"),
+            ("target_language", "Target language"),
+            ("sentence", "Source sentence"),
+            ("feedback", "Feedback"),
+            ("understanding", "Current understanding"),
+        ],
+    )
+
+    # Understanding-based translation
+    TRANSLATION = PromptTemplate(
+        "translation",
+        """
+Based on the source and target understandings below, translate the source sentence into the target language without any explanation.
+If a similar text and its translation are given, reuse that wording where the meaning is the same.
+""",
+        [
+            ("target_language", "Target language"),
+            ("source_understanding", "Source understanding"),
+            ("target_understanding", "Target understanding"),
+            ("similar_text", "Similar text"),
+            ("similar_translation", "Its translation"),
+            ("sentence", "Source sentence"),
+        ],
+    )
+
+    @classmethod
+    def registry(cls):
+        """
+        All templates
+
+        Returns:
+            dict: Template name -> PromptTemplate
+        """
+        return {value.name: value for value in vars(cls).values() if isinstance(value, PromptTemplate)}
+
+    @classmethod
+    def version(cls):
+        """Combined version hash of all templates, e.g. to tag benchmark and result records"""
+        versions = "".join(f"{name}:{template.version}" for name, template in sorted(cls.registry().items()))
+        return hashlib.sha256(versions.encode("utf-8")).hexdigest()[:12]
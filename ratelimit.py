@@ -0,0 +1,190 @@
+# Rate Limiting and Retry
+import asyncio
+import random
+import threading
+import time
+
+from budget import estimate_tokens
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` units per minute
+
+    Reservations may drive the bucket negative; the caller then waits until
+    the deficit has been refilled, which keeps waiting callers in FIFO order.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        """
+        Take `amount` units from the bucket
+
+        Returns:
+            float: Seconds to wait before the reservation is covered
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Client-side request-per-minute and token-per-minute limiter
+
+    One limiter is shared by every LLMModel (and so every IBUT instance) that uses
+    the same model; see `get_rate_limiter`. Token usage is estimated before a
+    request and settled against the reported usage afterwards.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, completion_tokens_estimate=512):
+        """
+        Initialize rate limiter
+
+        Args:
+            requests_per_minute: Request budget, None for unlimited
+            tokens_per_minute: Prompt plus completion token budget, None for unlimited
+            completion_tokens_estimate: Completion tokens assumed when reserving a request
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.completion_tokens_estimate = completion_tokens_estimate
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def estimate(self, prompt):
+        """Tokens reserved for a prompt"""
+        return estimate_tokens(prompt) + self.completion_tokens_estimate
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            return wait
+
+    def acquire(self, tokens):
+        """Block until a request of `tokens` tokens fits the budget"""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        """Wait, without blocking the event loop, until a request of `tokens` tokens fits the budget"""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, reserved, used):
+        """Correct a reservation with the token usage reported by the API"""
+        if self.tokens is None or used is None:
+            return
+        with self._lock:
+            if used < reserved:
+                self.tokens.refund(reserved - used)
+            else:
+                self.tokens.reserve(used - reserved, time.monotonic())
+
+    def pause(self, seconds):
+        """Hold back every request for `seconds`, e.g. after a Retry-After response"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name, requests_per_minute=None, tokens_per_minute=None, **kwargs):
+    """
+    Shared rate limiter of a model
+
+    The first call for a model creates its limiter with the given limits; later
+    calls return the same limiter, so every caller shares one budget.
+
+    Returns:
+        RateLimiter: The model's limiter
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(model_name)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute, **kwargs)
+            _rate_limiters[model_name] = limiter
+        return limiter
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After"""
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        """
+        Initialize retry policy
+
+        Args:
+            max_retries: Retries after the first attempt
+            base_delay: Backoff ceiling of the first retry in seconds, doubled on every retry
+            max_delay: Upper bound of the backoff ceiling in seconds
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number `attempt` (starting at 0)
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+def is_retryable(error):
+    """
+    Whether an API error is transient
+
+    Besides the openai exceptions, built-in timeout and connection errors and any
+    exception with a retryable `status_code` attribute count as transient.
+    """
+    import openai
+
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def retry_after_seconds(error):
+    """
+    Server-requested wait of a failed request
+
+    Returns:
+        float: Seconds from the retry-after-ms or Retry-After header, or None
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date form, not used by the providers we talk to
+        return None
+    return None
@@ -0,0 +1,150 @@
+# Resumable Corpus Runner
+import json
+import os
+
+from store import ResultStore, is_error, source_hash
+
+
+class StageCheckpoint:
+    """
+    Stage-level checkpoint of one sentence
+
+    Passed to `IBUT.translate_async`, which skips every stage already recorded here.
+    """
+
+    def __init__(self, runner, key):
+        self.runner = runner
+        self.key = key
+
+    def get(self, stage):
+        return self.runner.stages.get(self.key, {}).get(stage)
+
+    def put(self, stage, value):
+        # Failed calls are not checkpointed so that they are retried
+        if any(is_error(item) for item in value):
+            return
+        self.runner._write_checkpoint(self.key, stage, value)
+
+
+class ResumableRunner:
+    """
+    Resumable corpus runner
+
+    On start, the index of the output's ResultStore gives the completed lines
+    (line number -> source hash), and only the missing lines are translated.
+    Every record written carries its line number in "id". Understanding and
+    refinement results are checkpointed per sentence, so an interrupted sentence
+    resumes from its last finished stage.
+    """
+
+    def __init__(self, ibut_translator, output_file, direction="zh-en", checkpoint_file=None, max_in_flight=8):
+        """
+        Initialize runner
+
+        Args:
+            ibut_translator: IBUT instance
+            output_file: Output JSONL file with {"id", "src", "tgt", "hyp"} records
+            direction: Translation direction, e.g. "zh-en"
+            checkpoint_file: Stage checkpoint JSONL, defaults to `<output_file>.ckpt`
+            max_in_flight: Maximum number of sentences being translated at the same time
+        """
+        self.ibut = ibut_translator
+        self.output_file = output_file
+        self.direction = direction
+        self.checkpoint_file = checkpoint_file or output_file + ".ckpt"
+        self.max_in_flight = max_in_flight
+        self.stages = {}
+        self._checkpoint = None
+
+    def completed_index(self):
+        """
+        Scan the output file for completed lines
+
+        Records without an "id" (written before the runner existed) are
+        numbered by their position in the file.
+
+        Returns:
+            dict: line number -> source hash
+        """
+        index = {}
+        with ResultStore(self.output_file) as store:
+            for position, (record_id, digest, failed) in enumerate(zip(store.ids, store.hashes, store.failed)):
+                if not failed:
+                    index[position if record_id is None else record_id] = digest
+        return index
+
+    def _load_checkpoints(self, pending_keys):
+        """Load stage checkpoints of the sentences still to be translated"""
+        self.stages = {}
+        if not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record["key"] in pending_keys:
+                    self.stages.setdefault(record["key"], {})[record["stage"]] = record["value"]
+
+    def _write_checkpoint(self, key, stage, value):
+        self.stages.setdefault(key, {})[stage] = value
+        record = {"key": key, "stage": stage, "value": value}
+        self._checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._checkpoint.flush()
+
+    def run(self, items, progress_callback=None, line_numbers=None):
+        """
+        Translate every line of `items` that is not in the output file yet
+
+        Args:
+            items: List of {"src", "tgt"} dicts, one per corpus line
+            progress_callback: Optional callable(completed, total) invoked as lines finish
+            line_numbers: Optional corpus line numbers of `items`, e.g. when they are
+                one shard of a larger corpus; defaults to their positions
+
+        Returns:
+            dict: Number of lines skipped, translated and failed
+        """
+        completed = self.completed_index()
+        if line_numbers is None:
+            line_numbers = range(len(items))
+        pending = [
+            (line_number, item) for line_number, item in zip(line_numbers, items)
+            if completed.get(line_number) != source_hash(item["src"])
+        ]
+        keys = [f"{line_number}:{source_hash(item['src'])}" for line_number, item in pending]
+        self._load_checkpoints(set(keys))
+
+        summary = {"skipped": len(items) - len(pending), "translated": 0, "failed": 0}
+        if not pending:
+            return summary
+
+        def on_progress(done, index):
+            if progress_callback is not None:
+                progress_callback(done, len(pending))
+
+        with ResultStore(self.output_file) as output, \
+                open(self.checkpoint_file, "a", encoding="utf-8") as self._checkpoint:
+            results = self.ibut.translate_corpus(
+                (item["src"] for _, item in pending),
+                self.direction,
+                max_in_flight=self.max_in_flight,
+                progress_callback=on_progress,
+                checkpoint_factory=lambda index, sentence: StageCheckpoint(self, keys[index]),
+            )
+            for index, src, hyp in results:
+                if is_error(hyp):
+                    # Left out of the output so that the next run retries it
+                    summary["failed"] += 1
+                    continue
+                line_number, item = pending[index]
+                record = {"id": line_number, "src": src, "tgt": item.get("tgt"), "hyp": hyp}
+                output.append(record)
+                summary["translated"] += 1
+        self._checkpoint = None
+
+        if summary["failed"] == 0:
+            # Every pending sentence is in the output now
+            os.remove(self.checkpoint_file)
+        return summary
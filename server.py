@@ -0,0 +1,453 @@
+# Translation Service
+#
+# A small HTTP/JSON server around IBUT, built on asyncio streams:
+#
+#     python server.py --offline --port 8080
+#     curl -s localhost:8080/translate -d '{"text": "气候变化是人类面临的挑战。", "direction": "zh-en"}'
+#     curl -s localhost:8080/health
+#     curl -s localhost:8080/metrics
+#
+# Identical requests in flight share one computation, concurrent requests are
+# grouped into micro-batches for the corpus (or batch-file) path, and requests
+# beyond a bounded queue are rejected with 503.
+
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+import time
+from collections import Counter
+
+from langcodes import Language
+
+from store import is_error
+
+logger = logging.getLogger(__name__)
+
+SERVICE_MODES = ("corpus", "batch")
+MAX_BODY_BYTES = 1 << 20
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+}
+
+
+def known_language(code):
+    """Whether a language code names a language the prompts can refer to, e.g. "zh" but not "xx" or an empty code"""
+    if not code:
+        return False
+    language = Language.make(language=code)
+    return language.is_valid() and not language.display_name().startswith("Unknown language")
+
+
+class Overloaded(Exception):
+    """Raised when the request queue is full"""
+
+
+class TranslationService:
+    """
+    Request coalescing and micro-batching in front of an IBUT instance
+
+    Requests are keyed by (source sentence, direction). A request whose key is
+    already queued or being translated waits for that computation instead of
+    starting its own. New keys go into a bounded queue; a batcher task collects
+    up to `max_batch` of them, waiting at most `batch_window` seconds after the
+    first, and translates each direction's sentences in one call of
+    `translate_corpus_async` (or `translate_batch`). Up to `max_batches`
+    micro-batches run at a time; while they are all busy the queue fills up and
+    further requests are rejected.
+    """
+
+    def __init__(self, ibut_translator, max_queue=256, max_batch=32, batch_window=0.01, max_batches=4,
+                 max_in_flight=16, mode="corpus", collector=None):
+        """
+        Initialize service
+
+        Args:
+            ibut_translator: IBUT instance serving the requests
+            max_queue: Requests waiting for a micro-batch before `translate` raises Overloaded
+            max_batch: Maximum number of sentences in one micro-batch
+            batch_window: Seconds to wait for more requests after the first one of a micro-batch
+            max_batches: Micro-batches translated at the same time
+            max_in_flight: Sentences in flight within one micro-batch on the corpus path
+            mode: "corpus" runs micro-batches through `translate_corpus_async`, "batch"
+                through the stage-synchronous `translate_batch`
+            collector: Optional metrics.Metrics receiving the IBUT traces, exported by `prometheus`
+        """
+        if mode not in SERVICE_MODES:
+            raise ValueError(f"mode must be one of {SERVICE_MODES}, got {mode!r}")
+        self.ibut = ibut_translator
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_batches = max_batches
+        self.max_in_flight = max_in_flight
+        self.mode = mode
+        self.collector = collector
+        self.stats = Counter()
+        self._pending = {}
+        self._queue = None
+        self._slots = None
+        self._batcher = None
+        self._batches = set()
+
+    @property
+    def queued(self):
+        """Requests waiting for a micro-batch"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def in_flight(self):
+        """Distinct sentences queued or being translated"""
+        return len(self._pending)
+
+    async def start(self):
+        """Start the batcher on the running event loop"""
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.max_batches)
+        self._batcher = asyncio.create_task(self._run_batcher())
+
+    async def close(self):
+        """Stop the batcher and fail the requests that have not finished"""
+        tasks = [task for task in [self._batcher, *self._batches] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Service stopped"))
+        self._pending.clear()
+
+    async def translate(self, source_sentence, direction):
+        """
+        Translate one sentence, sharing the computation with identical requests in flight
+
+        Returns:
+            str: The translation, or an "Error: ..." string as returned by IBUT
+
+        Raises:
+            Overloaded: If the queue is full
+        """
+        self.stats["requests"] += 1
+        key = (source_sentence, direction)
+        future = self._pending.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self._queue.put_nowait((key, future))
+            except asyncio.QueueFull:
+                self.stats["rejected"] += 1
+                raise Overloaded(f"{self.max_queue} requests are already queued")
+            self._pending[key] = future
+        # Shielded, so a client that goes away does not cancel the shared computation
+        return await asyncio.shield(future)
+
+    async def _run_batcher(self):
+        """Collect queued requests into micro-batches and start them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch):
+        """Translate one micro-batch, one corpus call per direction"""
+        try:
+            self.stats["batches"] += 1
+            self.stats["batched_sentences"] += len(batch)
+            by_direction = {}
+            for key, future in batch:
+                by_direction.setdefault(key[1], []).append(key)
+            await asyncio.gather(*(self._translate_group(direction, keys) for direction, keys in by_direction.items()))
+        finally:
+            self._slots.release()
+
+    async def _translate_group(self, direction, keys):
+        """Translate the sentences of one direction and resolve their requests"""
+        sentences = [sentence for sentence, _ in keys]
+        try:
+            if self.mode == "batch":
+                translations = await asyncio.to_thread(self._translate_batch_files, sentences, direction)
+            else:
+                translations = [None] * len(sentences)
+                async for index, _, translation in self.ibut.translate_corpus_async(
+                    sentences, direction, max_in_flight=self.max_in_flight
+                ):
+                    translations[index] = translation
+                    self._resolve(keys[index], translation)
+        except Exception as error:
+            logger.exception("Micro-batch of %d %s sentences failed", len(keys), direction)
+            translations = [f"Error: {error}"] * len(keys)
+        for key, translation in zip(keys, translations):
+            self._resolve(key, translation)
+
+    def _translate_batch_files(self, sentences, direction):
+        """Run one micro-batch through batch files in a scratch directory"""
+        with tempfile.TemporaryDirectory(prefix="ibut-batch-") as directory:
+            return self.ibut.translate_batch(sentences, direction, directory=directory)
+
+    def _resolve(self, key, translation):
+        """Answer every request waiting for a sentence"""
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(translation)
+
+    def health(self):
+        """
+        Service state for the health endpoint
+
+        Returns:
+            dict: Status, queue depth and counters
+        """
+        return {
+            "status": "ok" if self._batcher is not None and not self._batcher.done() else "stopped",
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "max_queue": self.max_queue,
+            "mode": self.mode,
+            **{key: self.stats[key] for key in ("requests", "coalesced", "rejected", "batches", "batched_sentences")},
+        }
+
+    def prometheus(self, prefix="ibut"):
+        """
+        Service counters, followed by the trace aggregates of the collector if one is set
+
+        Returns:
+            str: Prometheus text exposition
+        """
+        lines = []
+        for name, kind, help_text, value in (
+            ("requests_total", "counter", "Translation requests received", self.stats["requests"]),
+            ("coalesced_requests_total", "counter", "Requests served by an identical request in flight",
+             self.stats["coalesced"]),
+            ("rejected_requests_total", "counter", "Requests rejected because the queue was full", self.stats["rejected"]),
+            ("micro_batches_total", "counter", "Micro-batches translated", self.stats["batches"]),
+            ("micro_batch_sentences_total", "counter", "Sentences translated in micro-batches",
+             self.stats["batched_sentences"]),
+            ("queued_requests", "gauge", "Requests waiting for a micro-batch", self.queued),
+            ("in_flight_sentences", "gauge", "Distinct sentences queued or being translated", self.in_flight),
+        ):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+        text = "\n".join(lines) + "\n"
+        if self.collector is not None:
+            text += self.collector.to_prometheus(prefix)
+        return text
+
+
+class TranslationServer:
+    """
+    Minimal HTTP/1.1 JSON front end of a TranslationService
+
+    Endpoints:
+        POST /translate  {"text": ..., "direction": "zh-en"} -> {"translation": ...}
+        GET  /health     service state as JSON
+        GET  /metrics    Prometheus text
+    """
+
+    def __init__(self, service, host="127.0.0.1", port=8080, default_direction="zh-en"):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.default_direction = default_direction
+        self._server = None
+
+    async def start(self):
+        """Start the service and listen; with port 0 the chosen port is stored in `port`"""
+        await self.service.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving on http://%s:%d", self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.service.close()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _handle_connection(self, reader, writer):
+        """Serve the requests of one keep-alive connection"""
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if isinstance(body, int):
+                    # The request could not be read; answer and drop the connection
+                    status, payload = body, {"error": HTTP_REASONS[body]}
+                    keep_alive = False
+                else:
+                    try:
+                        status, payload = await self._dispatch(method, path, body)
+                    except Exception:
+                        logger.exception("%s %s failed", method, path)
+                        status, payload = 500, {"error": HTTP_REASONS[500]}
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """
+        Read one request
+
+        Returns:
+            tuple: (method, path, headers, body bytes or an HTTP error status), None at end of connection
+        """
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            return "", "", {}, 400
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return method, path, headers, 400
+        if length > MAX_BODY_BYTES:
+            return method, path, headers, 413
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?", 1)[0], headers, body
+
+    async def _dispatch(self, method, path, body):
+        """
+        Route a request
+
+        Returns:
+            tuple: (HTTP status, JSON-serializable payload or Prometheus text)
+        """
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.service.health()
+        if path == "/metrics":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.service.prometheus()
+        if path != "/translate":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return 400, {"error": "body must be JSON"}
+        text = request.get("text") if isinstance(request, dict) else None
+        direction = request.get("direction", self.default_direction) if isinstance(request, dict) else None
+        if not isinstance(text, str) or not text.strip():
+            return 400, {"error": '"text" must be a non-empty string'}
+        languages = direction.split("-") if isinstance(direction, str) else []
+        if len(languages) != 2 or not all(known_language(code) for code in languages):
+            return 400, {"error": '"direction" must be two known language codes, e.g. "zh-en"'}
+
+        start = time.perf_counter()
+        try:
+            translation = await self.service.translate(text, direction)
+        except Overloaded as error:
+            return 503, {"error": str(error)}
+        elapsed = round(time.perf_counter() - start, 4)
+        if is_error(translation):
+            return 502, {"error": translation, "direction": direction, "elapsed": elapsed}
+        return 200, {"translation": translation, "direction": direction, "elapsed": elapsed}
+
+    async def _write_response(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+        headers = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if status == 503:
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+def main():
+    from cache import ResponseCache
+    from ibut import IBUT
+    from metrics import Metrics
+    from shard import make_model
+
+    parser = argparse.ArgumentParser(description="IBUT translation service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--direction", default="zh-en", help="direction of requests that do not give one")
+    parser.add_argument("--mode", choices=SERVICE_MODES, default="corpus")
+    parser.add_argument("--max-queue", type=int, default=256, help="queued requests before answering 503")
+    parser.add_argument("--max-batch", type=int, default=32, help="sentences per micro-batch")
+    parser.add_argument("--batch-window", type=float, default=0.01, help="seconds to wait for a micro-batch to fill")
+    parser.add_argument("--max-batches", type=int, default=4, help="micro-batches translated at the same time")
+    parser.add_argument("--max-in-flight", type=int, default=16, help="sentences in flight per micro-batch")
+    parser.add_argument("--max-iterations", type=int, default=1)
+    parser.add_argument("--cache", help="ResponseCache database")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--api-key")
+    parser.add_argument("--base-url")
+    parser.add_argument("--offline", action="store_true", help="use the offline backend")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in ("offline", "seed", "model", "api_key", "base_url")}
+    cache = ResponseCache(args.cache) if args.cache else None
+    collector = Metrics(keep_records=False)
+    ibut_translator = IBUT(make_model(options, cache), max_iterations=args.max_iterations, trace_callback=collector)
+    service = TranslationService(
+        ibut_translator, max_queue=args.max_queue, max_batch=args.max_batch, batch_window=args.batch_window,
+        max_batches=args.max_batches, max_in_flight=args.max_in_flight, mode=args.mode, collector=collector,
+    )
+    server = TranslationServer(service, args.host, args.port, default_direction=args.direction)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ibut_translator.model.close()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
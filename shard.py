@@ -0,0 +1,276 @@
+# Sharded Corpus Runner
+#
+# Splits a parallel corpus into shards, translates each shard in its own process
+# (or on its own host) into its own JSONL file, and merges the shards back into
+# one output in input order:
+#
+#     python shard.py run --source data/common/common.zh --reference data/common/common.en \
+#         --direction zh-en --output result/common.jsonl --num-shards 8
+#     python shard.py run ... --shards 0-3      # this host runs shards 0 to 3 of 8
+#     python shard.py merge --source data/common/common.zh --output result/common.jsonl --num-shards 8
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ResponseCache
+from store import ResultStore, source_hash
+
+logger = logging.getLogger(__name__)
+
+SHARD_STRATEGIES = ("hash", "range")
+
+
+def load_corpus(source, reference=None):
+    """
+    Load a parallel corpus
+
+    Args:
+        source: Result-style JSONL file with "src" (and "tgt") fields, or a text file
+            with one source sentence per line
+        reference: Optional text file with the reference translation of each line
+
+    Returns:
+        list: {"src", "tgt"} dicts in corpus order
+    """
+    if source.endswith(".jsonl"):
+        with open(source, "r", encoding="utf-8") as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        return [{"src": record["src"], "tgt": record.get("tgt")} for record in records]
+    with open(source, "r", encoding="utf-8") as file:
+        sources = [line.strip() for line in file]
+    references = [None] * len(sources)
+    if reference is not None:
+        with open(reference, "r", encoding="utf-8") as file:
+            references = [line.strip() for line in file]
+        if len(references) != len(sources):
+            raise ValueError(f"{source} has {len(sources)} lines but {reference} has {len(references)}")
+    return [{"src": src, "tgt": tgt} for src, tgt in zip(sources, references)]
+
+
+def shard_of(line_number, item, num_shards, total, strategy="hash"):
+    """
+    Shard a corpus line belongs to
+
+    "hash" spreads lines by a stable hash of the source sentence, so identical
+    sentences land in the same shard and share its cache; "range" gives every
+    shard a contiguous block of lines.
+    """
+    if strategy == "hash":
+        return int(source_hash(item["src"]), 16) % num_shards
+    if strategy == "range":
+        return line_number * num_shards // total
+    raise ValueError(f"strategy must be one of {SHARD_STRATEGIES}, got {strategy!r}")
+
+
+def shard_lines(items, shard, num_shards, strategy="hash"):
+    """
+    Lines of one shard
+
+    Returns:
+        tuple: (corpus line numbers, items) of the shard, in corpus order
+    """
+    selected = [
+        (line_number, item) for line_number, item in enumerate(items)
+        if shard_of(line_number, item, num_shards, len(items), strategy) == shard
+    ]
+    return [line_number for line_number, _ in selected], [item for _, item in selected]
+
+
+def shard_path(output, shard, num_shards):
+    """Output file of one shard, next to the merged output"""
+    root, extension = os.path.splitext(output)
+    return f"{root}.shard-{shard:03d}-of-{num_shards:03d}{extension or '.jsonl'}"
+
+
+def run_shard(items, shard, num_shards, output, direction, model_factory, strategy="hash", cache_path=None,
+              ibut_options=None, max_in_flight=8):
+    """
+    Translate one shard into its own JSONL file
+
+    Runs in a worker process, which opens its own cache handle and model client.
+    The shard file is written by a ResumableRunner, so a rerun only translates
+    the lines that are still missing.
+
+    Args:
+        items: The whole corpus, as returned by `load_corpus`
+        shard: Shard number, from 0
+        num_shards: Total number of shards
+        output: Path of the merged output; the shard file is derived from it
+        direction: Translation direction, e.g. "zh-en"
+        model_factory: Picklable callable(cache) returning the LLMModel of this worker
+        strategy: "hash" or "range"
+        cache_path: Optional ResponseCache database shared by the workers of a host; its size
+            limit applies to their combined writes
+        ibut_options: Optional dict of further IBUT arguments, e.g. {"max_iterations": 1}
+
+    Returns:
+        dict: Shard number and the runner summary
+    """
+    from ibut import IBUT
+    from runner import ResumableRunner
+
+    line_numbers, shard_items = shard_lines(items, shard, num_shards, strategy)
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+    ibut_translator = IBUT(model_factory(cache), **(ibut_options or {}))
+    try:
+        runner = ResumableRunner(
+            ibut_translator, shard_path(output, shard, num_shards), direction=direction, max_in_flight=max_in_flight
+        )
+        summary = runner.run(shard_items, line_numbers=line_numbers)
+    finally:
+        ibut_translator.close()
+        if cache is not None:
+            cache.close()
+    logger.info("Shard %d/%d: %s", shard, num_shards, summary)
+    return {"shard": shard, **summary}
+
+
+def run_sharded(items, output, direction, model_factory, num_shards, shards=None, workers=None, strategy="hash",
+                cache_path=None, ibut_options=None, max_in_flight=8):
+    """
+    Translate the given shards in a process pool
+
+    Args:
+        shards: Shard numbers to run on this host, defaults to all of them
+        workers: Worker processes, defaults to one per shard run here (at most one per CPU)
+        See `run_shard` for the other arguments.
+
+    Returns:
+        list: `run_shard` summaries in shard order
+    """
+    shards = list(range(num_shards)) if shards is None else list(shards)
+    workers = workers or min(len(shards), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                run_shard, items, shard, num_shards, output, direction, model_factory, strategy=strategy,
+                cache_path=cache_path, ibut_options=ibut_options, max_in_flight=max_in_flight,
+            )
+            for shard in shards
+        ]
+        return [future.result() for future in futures]
+
+
+def merge(items, output, num_shards):
+    """
+    Rebuild one output in input order from the shard files
+
+    Every corpus line must appear in exactly one shard record whose source matches
+    the corpus. Lines that are missing are left out of the merged file; for lines
+    written more than once, the last record wins.
+
+    Returns:
+        dict: Lines written, plus the line numbers that are missing, duplicated,
+            mismatched (source differs from the corpus) or out of range
+    """
+    records = {}
+    report = {"written": 0, "missing": [], "duplicated": [], "mismatched": [], "out_of_range": []}
+    for shard in range(num_shards):
+        path = shard_path(output, shard, num_shards)
+        if not os.path.exists(path):
+            continue
+        with ResultStore(path) as store:
+            for position, record_id in enumerate(store.ids):
+                if store.failed[position]:
+                    continue
+                if record_id is None or not 0 <= record_id < len(items):
+                    report["out_of_range"].append(record_id)
+                    continue
+                if store.hashes[position] != source_hash(items[record_id]["src"]):
+                    report["mismatched"].append(record_id)
+                    continue
+                if record_id in records:
+                    report["duplicated"].append(record_id)
+                records[record_id] = store.get(position)
+
+    with open(output, "w", encoding="utf-8") as file:
+        for line_number in range(len(items)):
+            record = records.get(line_number)
+            if record is None:
+                report["missing"].append(line_number)
+                continue
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            report["written"] += 1
+    return report
+
+
+def make_model(options, cache):
+    """Model of a worker process, built from command line options"""
+    from model import LLMModel, OfflineLLMModel
+
+    if options["offline"]:
+        return OfflineLLMModel(seed=options["seed"], cache=cache)
+    return LLMModel(
+        model_name=options["model"],
+        api_key=options["api_key"] or os.environ.get("OPENAI_API_KEY"),
+        base_url=options["base_url"],
+        cache=cache,
+    )
+
+
+def parse_shards(value, num_shards):
+    """Shard selection such as "0-3,6", defaulting to all shards"""
+    if not value:
+        return list(range(num_shards))
+    shards = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        shards.extend(range(int(first), int(last or first) + 1))
+    if any(not 0 <= shard < num_shards for shard in shards):
+        raise SystemExit(f"shards must be between 0 and {num_shards - 1}: {value}")
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded IBUT corpus runner")
+    parser.add_argument("command", choices=("run", "merge"))
+    parser.add_argument("--source", required=True, help="source text file, or JSONL with a src column")
+    parser.add_argument("--reference", help="reference text file parallel to --source")
+    parser.add_argument("--output", required=True, help="merged output JSONL; shard files are written next to it")
+    parser.add_argument("--direction", default="zh-en")
+    parser.add_argument("--num-shards", type=int, required=True)
+    parser.add_argument("--shards", help="shards to run on this host, e.g. 0-3,6; default all")
+    parser.add_argument("--strategy", choices=SHARD_STRATEGIES, default="hash")
+    parser.add_argument("--workers", type=int, help="worker processes, default one per shard up to the CPU count")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="sentences in flight per worker")
+    parser.add_argument("--max-iterations", type=int, default=1)
+    parser.add_argument("--cache", help="ResponseCache database shared by the workers")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--api-key")
+    parser.add_argument("--base-url")
+    parser.add_argument("--offline", action="store_true", help="use the offline backend")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    items = load_corpus(args.source, args.reference)
+    if args.command == "run":
+        options = {key: getattr(args, key) for key in ("offline", "seed", "model", "api_key", "base_url")}
+        summaries = run_sharded(
+            items, args.output, args.direction, functools.partial(make_model, options), args.num_shards,
+            shards=parse_shards(args.shards, args.num_shards), workers=args.workers, strategy=args.strategy,
+            cache_path=args.cache, ibut_options={"max_iterations": args.max_iterations},
+            max_in_flight=args.max_in_flight,
+        )
+        for summary in summaries:
+            print(json.dumps(summary))
+        if args.shards:
+            # Other hosts run the remaining shards; merge once they are all done
+            return
+
+    report = merge(items, args.output, args.num_shards)
+    print(json.dumps({key: value if key == "written" else len(value) for key, value in report.items()}))
+    if any(report[key] for key in ("missing", "duplicated", "mismatched", "out_of_range")):
+        for key in ("missing", "duplicated", "mismatched", "out_of_range"):
+            if report[key]:
+                print(f"{key}: {report[key][:20]}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,247 @@
+# Result Store
+import hashlib
+import json
+import mmap
+import os
+
+
+def source_hash(sentence):
+    """
+    Stable hash of a source sentence
+
+    Returns:
+        str: Short hex digest of the stripped sentence
+    """
+    return hashlib.sha1(sentence.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def is_error(text):
+    """Whether a hypothesis is missing or the error string returned by LLMModel"""
+    return not isinstance(text, str) or text.startswith("Error:")
+
+
+class ResultStore:
+    """
+    JSONL result file with a persistent byte-offset index
+
+    The index (`<path>.idx`) holds, per line, its byte offset, source hash,
+    "id" (if any) and whether the hypothesis is an error. Records are read
+    through `mmap`, so looking one up never loads the whole file. The index is
+    brought up to date incrementally when the file has grown since it was
+    written, and rebuilt if the file was rewritten or edited: its first bytes,
+    its last indexed line and the line starts it records must still match.
+    """
+
+    def __init__(self, path, fsync_every=32):
+        """
+        Open or create a result store
+
+        Args:
+            path: JSONL file with {"src", "tgt", "hyp"} records, optionally with "id"
+            fsync_every: Appended records between fsyncs of the file and index
+        """
+        self.path = path
+        self.index_path = path + ".idx"
+        self.fsync_every = fsync_every
+        self.offsets = []
+        self.hashes = []
+        self.ids = []
+        self.failed = []
+        self.end = 0
+        self._by_hash = {}
+        self._by_id = {}
+        self._map = None
+        self._writer = None
+        self._unsynced = 0
+
+        if not os.path.exists(path):
+            open(path, "a", encoding="utf-8").close()
+        self._load_index()
+        self._update_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as file:
+            index = json.load(file)
+        if not self._index_matches(index):
+            return
+        self.offsets, self.hashes, self.ids, self.failed = index["offsets"], index["hashes"], index["ids"], index["failed"]
+        self.end = index["end"]
+        for position in range(len(self.offsets)):
+            self._remember(position)
+
+    def _index_matches(self, index):
+        """Whether a saved index still describes the indexed part of the file"""
+        # A shorter file means the file was rewritten
+        if os.path.getsize(self.path) < index["end"]:
+            return False
+        if index["end"] == 0:
+            return True
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(index["head"].encode("latin-1"))].decode("latin-1") != index["head"]:
+                return False
+            offsets = index["offsets"]
+            last = offsets[-1] if offsets else 0
+            if hashlib.sha1(mapped[last:index["end"]]).hexdigest() != index.get("tail"):
+                return False
+            # Edits in the middle shift the following lines off their recorded starts
+            return mapped[index["end"] - 1] == 0x0A and all(
+                mapped[offset - 1] == 0x0A for offset in offsets if offset > 0
+            )
+
+    def _remember(self, position):
+        self._by_hash[self.hashes[position]] = position
+        if self.ids[position] is not None:
+            self._by_id[self.ids[position]] = position
+
+    def _add(self, offset, record):
+        self.offsets.append(offset)
+        self.hashes.append(source_hash(record["src"]))
+        self.ids.append(record.get("id"))
+        self.failed.append(is_error(record.get("hyp")))
+        self._remember(len(self.offsets) - 1)
+
+    def _update_index(self):
+        """Index the lines appended since the index was written"""
+        size = os.path.getsize(self.path)
+        if size == self.end:
+            return
+        with open(self.path, "rb") as file:
+            file.seek(self.end)
+            offset = self.end
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Truncated last line left by a crash; not indexed until completed
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    offset += len(line)
+                    continue
+                self._add(offset, record)
+                offset += len(line)
+        self.end = offset
+        self._save_index()
+
+    def _save_index(self):
+        with open(self.path, "rb") as file:
+            head = file.read(256).decode("latin-1")
+            last = self.offsets[-1] if self.offsets else 0
+            file.seek(last)
+            tail = hashlib.sha1(file.read(self.end - last)).hexdigest()
+        index = {
+            "end": self.end,
+            "head": head,
+            "tail": tail,
+            "offsets": self.offsets,
+            "hashes": self.hashes,
+            "ids": self.ids,
+            "failed": self.failed,
+        }
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        os.replace(temporary, self.index_path)
+
+    def _mapped(self):
+        """Memory map covering every indexed line"""
+        if self._map is None or len(self._map) < self.end:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for position in range(len(self.offsets)):
+            yield self.get(position)
+
+    def get(self, position):
+        """
+        Record at a line position of the file
+
+        Returns:
+            dict: The decoded record
+        """
+        if self._writer is not None:
+            # Make buffered appends visible to the map; durability is left to flush()
+            self._writer.flush()
+        start = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.end
+        return json.loads(self._mapped()[start:end])
+
+    def by_id(self, record_id):
+        """Record with the given "id", or None"""
+        position = self._by_id.get(record_id)
+        return None if position is None else self.get(position)
+
+    def lookup(self, source):
+        """Latest record for a source sentence, or None"""
+        position = self._by_hash.get(source_hash(source))
+        return None if position is None else self.get(position)
+
+    def hypothesis(self, source):
+        """Latest hypothesis for a source sentence, or None"""
+        record = self.lookup(source)
+        return None if record is None else record.get("hyp")
+
+    def changed(self, other):
+        """
+        Sources whose hypothesis differs between this store and another run
+
+        Returns:
+            list: (source, this hypothesis, other hypothesis) for sources in both stores
+        """
+        changes = []
+        for digest, position in self._by_hash.items():
+            other_position = other._by_hash.get(digest)
+            if other_position is None:
+                continue
+            record, other_record = self.get(position), other.get(other_position)
+            if record.get("hyp") != other_record.get("hyp"):
+                changes.append((record["src"], record.get("hyp"), other_record.get("hyp")))
+        return changes
+
+    def append(self, record):
+        """Append a record; it is fsynced with the next batch of `fsync_every` records"""
+        if self._writer is None:
+            self._update_index()
+            # Drop a truncated last line so the new record starts on a line of its own
+            if os.path.getsize(self.path) > self.end:
+                os.truncate(self.path, self.end)
+            self._writer = open(self.path, "ab")
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._writer.write(line)
+        self._add(self.end, record)
+        self.end += len(line)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.flush()
+
+    def flush(self):
+        """Write appended records to disk and persist the index"""
+        if self._writer is None:
+            return
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._unsynced = 0
+        self._save_index()
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
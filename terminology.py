@@ -0,0 +1,142 @@
+# Terminology Cache
+import re
+import threading
+from collections import OrderedDict
+
+# "term: explanation" / "term - explanation" lines of an understanding that are bulleted,
+# numbered or start with a bold term, e.g. "1. Carbon Neutrality - ..." or "**碳中和**（carbon
+# neutrality）：..."; a parenthesized gloss after the term, in half- or full-width
+# parentheses, is kept apart from it
+_TERM_LINE_RE = re.compile(
+    r"^\s*(?:(?:[-*•]|\d+[.)、])\s*(?:\*\*)?|\*\*)"
+    r"(?P<term>[^:：\n*()（）]+?)(?:\*\*)?\s*"
+    r"(?:[(（](?P<gloss>[^()（）\n]*)[)）])?\s*(?:\*\*)?\s*"
+    r"(?:[:：]|\s[-–—]\s)\s*(?:\*\*)?\s*(?P<explanation>\S.*)$",
+    re.MULTILINE,
+)
+
+# Section headings that look like terms in "Definition: ..." lines
+_HEADING_WORDS = frozenset({
+    "definition", "definitions", "example", "examples", "explanation", "explanations", "key concepts",
+    "key concept", "concepts", "terms", "key terms", "meaning", "context", "note", "notes", "summary",
+    "translation", "定义", "释义", "解释", "例子", "示例", "举例", "关键概念", "概念", "术语", "关键术语",
+    "含义", "意义", "背景", "语境", "注意", "说明", "总结", "翻译",
+})
+
+MAX_TERM_LENGTH = 40
+MAX_TERM_WORDS = 5
+
+
+def _occurs(term, text):
+    """Whether a lowercased term occurs in a lowercased text; Latin-script terms must be whole words"""
+    if term.isascii():
+        return re.search(r"(?<!\w)" + re.escape(term) + r"(?!\w)", text) is not None
+    return term in text
+
+
+def extract_terms(understanding):
+    """
+    Terms explained in a generated understanding
+
+    Returns:
+        list: (term, explanation) pairs, in the order they appear
+    """
+    terms = []
+    for match in _TERM_LINE_RE.finditer(understanding):
+        term = match.group("term").strip(" \"'“”‘’「」《》")
+        # Longer "terms" are sentences of prose, not glossary entries
+        if len(term) < 2 or len(term) > MAX_TERM_LENGTH or len(term.split()) > MAX_TERM_WORDS:
+            continue
+        if term.lower() in _HEADING_WORDS:
+            continue
+        explanation = match.group("explanation").strip()
+        gloss = (match.group("gloss") or "").strip()
+        terms.append((term, f"({gloss}) {explanation}" if gloss else explanation))
+    return terms
+
+
+class TerminologyCache:
+    """
+    LRU cache of term explanations taken from generated understandings
+
+    Entries are scoped per translation direction and per side ("source" or
+    "target" understanding). A cached term is offered to the understanding
+    prompts of later sentences that contain it, so the model can refer to it
+    briefly instead of explaining it again. Target-side terms are in the target
+    language and often never occur in a source sentence (e.g. for zh-en), so each
+    is also tied to the source terms it explains and found through them.
+    """
+
+    def __init__(self, max_entries=2048, max_terms_per_prompt=8, max_explanation_chars=200):
+        """
+        Initialize terminology cache
+
+        Args:
+            max_entries: Entries kept over all directions before the least recently used are evicted
+            max_terms_per_prompt: Maximum number of known terms offered to one prompt
+            max_explanation_chars: Cached explanations are cut to this many characters
+        """
+        self.max_entries = max_entries
+        self.max_terms_per_prompt = max_terms_per_prompt
+        self.max_explanation_chars = max_explanation_chars
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, direction, side, understanding, source_terms=None):
+        """
+        Cache the terms explained in an understanding
+
+        Args:
+            source_terms: For a target-side understanding, the terms explained by the
+                source-side understanding of the same sentence, in order. A target term
+                is tied to the source terms mentioned in its entry, or else to the
+                source term at the same position.
+
+        Returns:
+            int: Number of terms cached
+        """
+        terms = extract_terms(understanding)
+        source_terms = [term.lower() for term in source_terms or []]
+        with self._lock:
+            for position, (term, explanation) in enumerate(terms):
+                entry = f"{term} {explanation}".lower()
+                anchors = [source_term for source_term in source_terms if _occurs(source_term, entry)]
+                if not anchors and position < len(source_terms):
+                    anchors = [source_terms[position]]
+                key = (direction, side, term.lower())
+                self._entries[key] = (term, explanation[:self.max_explanation_chars], tuple(anchors))
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return len(terms)
+
+    def lookup(self, source_sentence, direction, side):
+        """
+        Cached terms that occur in a source sentence
+
+        Terms occur either themselves or, for target-side terms, through a source
+        term they are tied to.
+
+        Returns:
+            list: Up to `max_terms_per_prompt` (term, explanation) pairs, longest terms first
+        """
+        text = source_sentence.lower()
+        with self._lock:
+            keys = [
+                key for key, (_, _, anchors) in self._entries.items()
+                if key[0] == direction and key[1] == side
+                and (_occurs(key[2], text) or any(_occurs(anchor, text) for anchor in anchors))
+            ]
+            keys.sort(key=lambda key: len(key[2]), reverse=True)
+            keys = keys[:self.max_terms_per_prompt]
+            for key in keys:
+                self._entries.move_to_end(key)
+            return [self._entries[key][:2] for key in keys]
+
+
+def format_known_terms(terms):
+    """Items of the "Known terms" prompt field, empty if there are none"""
+    return [f"{term}: {explanation}" for term, explanation in terms]
@@ -2,6 +2,9 @@
 
 from model import LLMModel
 from ibut import IBUT
+from cache import ResponseCache
+from runner import ResumableRunner
+import logging
 import time
 from langcodes import Language
 
@@ -130,11 +133,13 @@ def test_iteration_impact():
     test_sentence = "气候变化是当今人类面临的最严峻挑战之一，我们需要立即采取行动减少温室气体排放，实现碳中和。"
     
     results = {}
+    # Stages shared between iteration settings are answered from the cache
+    cache = ResponseCache()
     
     for iterations in [0, 1, 2, 3]:
         print(f"\n\niteration nums: {iterations}")
         
-        model = LLMModel(model_name="gpt-3.5-turbo")
+        model = LLMModel(model_name="gpt-3.5-turbo", cache=cache)
         ibut_translator = IBUT(model, max_iterations=iterations)
         
         translation = ibut_translator.translate(test_sentence)
@@ -172,7 +177,7 @@ def main():
     api_key = ""
     # model settings
     max_iterations=1
-    model = LLMModel(model_name=model, api_key=api_key)
+    model = LLMModel(model_name=model, api_key=api_key, cache=ResponseCache())
 
     # model = LLMModel(model_name="gpt-3.5-turbo")
     ibut_translator = IBUT(model, max_iterations=max_iterations)
@@ -181,30 +186,19 @@ def main():
     
     test_data = read_common()
     output_file = '/Users/chenandong/Documents/哈工大2024-2025/投稿/IBUT生成能力与翻译/code_submitted/result/deepseek-common.jsonl'
-    with open(output_file, 'a', encoding='utf-8') as file:
-
-        for item in test_data:
-            src_lang = item["src_lang"]
-            tgt_lang = item["tgt_lang"]
-            src = item["src"]
-            tgt = item["tgt"]
-            ibut_translation = ibut_translator.translate(src)
-            
-            output_dict = {"src": src,"tgt": tgt,"hyp": ibut_translation}
-            line = json.dumps(output_dict, ensure_ascii=False) + "\n"
-            file.write(line)
-            file.flush()
-
-         
-    # ibut_translation = ibut_translator.translate(test_sentence)
+    # Lines already in the output file are skipped, interrupted sentences resume from their last stage
+    runner = ResumableRunner(ibut_translator, output_file, direction="zh-en", max_in_flight=8)
+    summary = runner.run(test_data)
     
-    print(f"The result of IBUT: {ibut_translation}")
+    print(f"The result of IBUT: {summary}")
     # comparison = compare_with_baseline(test_sentence, ibut_translator, model)
     
     return {
         # "domain_results": domain_results,
-        "iteration_results": ibut_translation
+        "iteration_results": summary
     }
 
 if __name__ == "__main__":
+    # Stage progress of IBUT is logged at INFO, prompts and understandings at DEBUG
+    logging.basicConfig(level=logging.INFO)
     main()
\ No newline at end of file
@@ -0,0 +1,228 @@
+# Offline pipeline tests, run with the deterministic OfflineLLMModel backend
+
+import asyncio
+
+import pytest
+
+import metrics
+from cache import ResponseCache
+from document import SegmentTranslationError
+from ibut import IBUT
+from model import OfflineLLMModel, classify_prompt
+from ratelimit import RetryPolicy
+from runner import ResumableRunner
+from store import ResultStore, is_error
+from tm import TranslationMemory
+
+SENTENCES = [
+    "气候变化是人类面临的共同挑战。",
+    "碳中和目标需要各国共同努力。",
+    "可持续发展离不开技术创新。",
+    "人工智能正在改变各行各业。",
+    "温室气体排放持续增加。",
+    "可再生能源的成本不断下降。",
+    "森林保护有助于减缓全球变暖。",
+    "城市交通需要更加绿色低碳。",
+]
+
+
+def offline_model(**kwargs):
+    """Offline model without retries, recording every prompt it is sent"""
+    model = OfflineLLMModel(retry_policy=RetryPolicy(max_retries=0, base_delay=0.0), **kwargs)
+    model.prompts = []
+    agenerate = model.agenerate
+
+    async def recording_agenerate(prompt):
+        model.prompts.append(prompt)
+        return await agenerate(prompt)
+
+    model.agenerate = recording_agenerate
+    return model
+
+
+def test_failed_calls_are_not_used_as_understandings(tmp_path):
+    model = offline_model(error_rate=0.3, seed=1)
+    traces = []
+    with IBUT(model, trace_callback=traces.append) as ibut:
+        runner = ResumableRunner(ibut, str(tmp_path / "out.jsonl"), direction="zh-en")
+        summary = runner.run([{"src": sentence, "tgt": None} for sentence in SENTENCES * 3])
+
+    # No error text is ever passed on as an understanding, feedback or translation input
+    assert not [prompt for prompt in model.prompts if "Error:" in prompt]
+    # Sentences whose understanding failed are failed, not translated from the error text
+    failed_understandings = [trace["outcome"] for trace in traces].count("understanding_error")
+    assert failed_understandings > 1
+    assert summary["failed"] >= failed_understandings
+    assert summary["translated"] + summary["failed"] == len(SENTENCES) * 3
+    with ResultStore(str(tmp_path / "out.jsonl")) as store:
+        assert not any(store.failed)
+
+
+def test_failed_refinement_keeps_last_good_understandings():
+    model = offline_model(alignment_pass_rate=0.0)
+    with IBUT(model, max_iterations=2) as ibut:
+        source, target = ibut.generate_understanding(SENTENCES[0])
+        ibut.model.error_rate = 1.0
+        trace = metrics.new_trace(SENTENCES[0], "zh-en")
+
+        async def refine():
+            with metrics.tracing(trace):
+                return await ibut.iterative_refinement_async(
+                    SENTENCES[0], source, target, "zh-en", initial_judgment=(False, "feedback", "feedback")
+                )
+
+        assert ibut._run(refine()) == (source, target)
+    assert trace["outcome"] == "refinement_error"
+    assert ibut.stats["refinement_errors"] == 1
+
+
+def test_broken_stream_sends_error_and_is_not_remembered():
+    model = offline_model(alignment_pass_rate=1.0)
+    acreate_stream = model._acreate_stream
+
+    async def breaking_stream(prompt):
+        chunks = await acreate_stream(prompt)
+
+        async def broken():
+            async for chunk in chunks:
+                yield chunk
+                raise ConnectionError("Connection reset")
+
+        return broken()
+
+    model._acreate_stream = breaking_stream
+    memory = TranslationMemory()
+    with IBUT(model, translation_memory=memory) as ibut:
+        events = list(ibut.translate_stream(SENTENCES[0]))
+    assert [event["type"] for event in events][-2:] == ["chunk", "error"]
+    assert "Connection reset" in events[-1]["error"]
+    assert memory.exact(SENTENCES[0], "zh-en") is None
+
+
+def test_cache_hits_are_not_counted_as_calls(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    summaries = []
+    for _ in range(2):
+        collector = metrics.Metrics()
+        with IBUT(offline_model(cache=cache), trace_callback=collector) as ibut:
+            for sentence in SENTENCES[:3]:
+                ibut.translate(sentence)
+        summaries.append((collector.summary(), ibut.stats["llm_calls"]))
+    cache.close()
+
+    (cold, cold_calls), (warm, warm_calls) = summaries
+    assert cold["calls_per_sentence"] > 0 and cold_calls > 0
+    assert warm["calls_per_sentence"] == 0 and warm_calls == 0
+    hits = [sum(entry["cache_hits"] for entry in summary["stages"].values()) for summary in (cold, warm)]
+    assert hits[1] == hits[0] + cold_calls
+
+
+def test_batch_translation_inside_a_running_event_loop(tmp_path):
+    with IBUT(offline_model()) as ibut:
+        async def caller():
+            # e.g. a notebook cell
+            return ibut.translate_batch(SENTENCES[:2], directory=str(tmp_path))
+
+        translations = asyncio.run(caller())
+    assert len(translations) == 2 and not any(is_error(translation) for translation in translations)
+
+
+def test_speculation_is_kept_after_a_failed_judgment():
+    model = offline_model(alignment_pass_rate=0.0)
+    agenerate = model.agenerate
+
+    async def failing_judgment(prompt):
+        if classify_prompt(prompt) == "judgment":
+            return "Error: Simulated server error"
+        return await agenerate(prompt)
+
+    model.agenerate = failing_judgment
+    with IBUT(model, speculative=True) as ibut:
+        translation = ibut.translate(SENTENCES[0])
+    assert not is_error(translation)
+    assert ibut.stats["speculation_hits"] == 1 and ibut.stats["speculation_wasted"] == 0
+    assert model.calls["translation"] == 1
+
+
+def test_failed_fused_judgment_does_not_fall_back():
+    model = offline_model()
+    agenerate = model.agenerate
+
+    async def failing_judgment(prompt):
+        if classify_prompt(prompt) == "fused_judgment":
+            return "Error: Simulated server error"
+        return await agenerate(prompt)
+
+    model.agenerate = failing_judgment
+    with IBUT(model, judgment_mode="fused") as ibut:
+        judgment = ibut.alignment_judgment(SENTENCES[0], "source", "target", "zh-en")
+    assert judgment == (False, None, None)
+    assert ibut.stats["judgment_errors"] == 1 and ibut.stats["fused_judgment_fallbacks"] == 0
+    assert model.calls["judgment"] == model.calls["feedback"] == 0
+
+
+def test_failed_document_segments_are_reported_not_spliced_in():
+    model = offline_model(alignment_pass_rate=1.0)
+    agenerate = model.agenerate
+
+    async def failing_segment(prompt):
+        if classify_prompt(prompt) == "translation" and "Source sentence: Rivers" in prompt:
+            return "Error: Simulated server error"
+        return await agenerate(prompt)
+
+    model.agenerate = failing_segment
+    passage = "===Hydrography===Lakes are rare here.*Rivers cross the town.*Springs feed the wells."
+    with IBUT(model) as ibut:
+        with pytest.raises(SegmentTranslationError) as raised:
+            ibut.translate_document(passage, direction="en-fr")
+    assert raised.value.failed == [2]
+    assert raised.value.errors == ["Error: Simulated server error"]
+    assert "Error" not in raised.value.translation
+    assert "*Rivers cross the town.*" in raised.value.translation
+
+
+def test_prompts_are_routed_by_template():
+    model = offline_model(alignment_pass_rate=0.0)
+    with IBUT(model) as ibut:
+        sentence, direction = SENTENCES[0], "zh-en"
+        prompts = {
+            "understanding": ibut._create_source_understanding_prompt(sentence, "Chinese"),
+            "fused_understanding": ibut._create_fused_understanding_prompt(sentence, "Chinese", "English"),
+            "judgment": ibut._create_alignment_judgment_prompt(sentence, "source", "target", direction),
+            "feedback": ibut._create_alignment_judgment_prompt_source_2(sentence, "source", "True", "Chinese"),
+            "fused_judgment": ibut._create_fused_alignment_judgment_prompt(sentence, "source", "target", direction),
+            "refinement": ibut._create_refinement_prompt(sentence, "source", "feedback", direction),
+            "translation": ibut._create_translation_prompt(sentence, "source", "target", direction),
+        }
+        assert {prompt_type: classify_prompt(prompt) for prompt_type, prompt in prompts.items()} == {
+            prompt_type: prompt_type for prompt_type in prompts
+        }
+        assert classify_prompt("Say hello") == "other"
+
+        responses = {prompt_type: model.generate(prompt) for prompt_type, prompt in prompts.items()}
+        assert not any(is_error(response) for response in responses.values())
+        assert all(ibut._parse_fused_understanding(responses["fused_understanding"]))
+        assert responses["judgment"].startswith("True")
+        assert ibut._parse_fused_judgment_result(responses["fused_judgment"])[0] is False
+        assert dict(model.calls) == dict.fromkeys(prompts, 1)
+
+
+def test_injected_errors_and_timeouts_follow_their_rates():
+    prompts = [f"Say hello to visitor {number}" for number in range(400)]
+    for rate_name, message in (("error_rate", "Simulated server error"), ("timeout_rate", "Simulated request timeout")):
+        model = offline_model(timeout=0.0, seed=7, **{rate_name: 0.25})
+        responses = [model.generate(prompt) for prompt in prompts]
+        failed = [response for response in responses if is_error(response)]
+        assert 0.18 < len(failed) / len(prompts) < 0.32
+        assert all(message in response for response in failed)
+        # Outcomes depend on the seed and prompt only
+        again = offline_model(timeout=0.0, seed=7, **{rate_name: 0.25})
+        assert [again.generate(prompt) for prompt in prompts] == responses
+
+
+def test_retries_recover_from_injected_errors():
+    model = OfflineLLMModel(error_rate=0.2, timeout_rate=0.05, timeout=0.0,
+                            retry_policy=RetryPolicy(max_retries=5, base_delay=0.0))
+    responses = [model.generate(f"Say hello to visitor {number}") for number in range(100)]
+    assert not any(is_error(response) for response in responses)
+    assert sum(model.calls.values()) > 100
@@ -0,0 +1,146 @@
+# Translation service tests, run against the offline backend
+
+import asyncio
+import json
+
+from ibut import IBUT
+from model import OfflineLLMModel
+from server import TranslationServer, TranslationService
+
+SENTENCE = "气候变化是人类面临的共同挑战。"
+
+
+async def send(port, method, path, payload=None):
+    """
+    Send one HTTP request
+
+    Returns:
+        tuple: (status, headers dict, decoded JSON body or text)
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+        .encode("latin-1") + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+    if headers["Content-Type"] == "application/json":
+        body = json.loads(body)
+    return int(lines[0].split()[1]), headers, body.decode("utf-8") if isinstance(body, bytes) else body
+
+
+def serve(test, **options):
+    """Run `test(server)` against a server on a free port, with an offline IBUT behind it"""
+    ibut = IBUT(OfflineLLMModel(**options.pop("model", {})), max_iterations=1)
+    server = TranslationServer(TranslationService(ibut, **options), port=0)
+
+    async def run():
+        await server.start()
+        try:
+            return await test(server)
+        finally:
+            await server.close()
+
+    try:
+        return asyncio.run(run())
+    finally:
+        ibut.close()
+
+
+def test_translate():
+    async def test(server):
+        return await send(server.port, "POST", "/translate", {"text": SENTENCE, "direction": "zh-en"})
+
+    status, _, payload = serve(test)
+    assert status == 200
+    assert payload["translation"] and payload["direction"] == "zh-en"
+
+
+def test_direction_must_be_two_known_languages():
+    async def test(server):
+        return [
+            (await send(server.port, "POST", "/translate", {"text": SENTENCE, "direction": direction}))[0]
+            for direction in ("zh-", "-en", "zh", "zh-en-fr", "xx-en", "zh-EN")
+        ]
+
+    assert serve(test) == [400] * 6
+
+
+def test_unexpected_error_is_answered_with_500():
+    async def test(server):
+        async def broken(text, direction):
+            raise RuntimeError("boom")
+
+        server.service.translate = broken
+        return await send(server.port, "POST", "/translate", {"text": SENTENCE})
+
+    status, headers, payload = serve(test)
+    assert status == 500
+    assert headers["Content-Type"] == "application/json" and "error" in payload
+
+
+async def wait_for(condition, timeout=5.0):
+    """Poll until `condition()` holds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "condition not reached"
+        await asyncio.sleep(0.005)
+
+
+def test_identical_requests_are_coalesced():
+    async def test(server):
+        responses = await asyncio.gather(*(
+            send(server.port, "POST", "/translate", {"text": SENTENCE, "direction": "zh-en"}) for _ in range(5)
+        ))
+        return responses, server.service
+
+    responses, service = serve(test, model={"latency": 0.02}, batch_window=0.02)
+    assert [status for status, _, _ in responses] == [200] * 5
+    assert len({payload["translation"] for _, _, payload in responses}) == 1
+    assert service.stats["requests"] == 5 and service.stats["coalesced"] == 4
+    assert service.ibut.model.calls["translation"] == 1
+
+
+def test_concurrent_requests_share_micro_batches():
+    sentences = [f"{SENTENCE[:-1]}，第{number}次。" for number in range(6)]
+
+    def run(max_batch):
+        async def test(server):
+            responses = await asyncio.gather(*(
+                send(server.port, "POST", "/translate", {"text": sentence}) for sentence in sentences
+            ))
+            return [status for status, _, _ in responses], server.service.stats
+
+        return serve(test, max_batch=max_batch, batch_window=0.2)
+
+    statuses, stats = run(max_batch=32)
+    assert statuses == [200] * 6
+    assert stats["batches"] == 1 and stats["batched_sentences"] == 6
+    statuses, stats = run(max_batch=2)
+    assert statuses == [200] * 6
+    assert stats["batches"] == 3 and stats["batched_sentences"] == 6
+
+
+def test_full_queue_is_answered_with_503():
+    async def test(server):
+        service = server.service
+        # The first request occupies the only micro-batch slot, the second the only queue place
+        first = asyncio.ensure_future(send(server.port, "POST", "/translate", {"text": SENTENCE}))
+        await wait_for(lambda: service.stats["batches"] == 1)
+        second = asyncio.ensure_future(send(server.port, "POST", "/translate", {"text": SENTENCE[:-1] + "！"}))
+        await wait_for(lambda: service.queued == 1)
+        rejected = await send(server.port, "POST", "/translate", {"text": SENTENCE[:-1] + "？"})
+        return rejected, await first, await second, service.stats
+
+    (status, headers, payload), first, second, stats = serve(
+        test, model={"latency": 0.1}, max_queue=1, max_batches=1, batch_window=0.0
+    )
+    assert status == 503 and headers["Retry-After"] == "1" and "error" in payload
+    assert first[0] == second[0] == 200
+    assert stats["rejected"] == 1
@@ -0,0 +1,54 @@
+# Terminology extraction and cache tests
+
+from terminology import TerminologyCache, extract_terms
+
+
+def test_bulleted_and_numbered_terms():
+    understanding = """Key Concepts:
+1. Climate Change - Long-term changes in Earth's climate system
+- Carbon Neutrality: Net zero carbon dioxide emissions
+* **Paris Agreement**: A 2015 climate treaty
+This line is prose: it explains nothing in particular
+"""
+    assert extract_terms(understanding) == [
+        ("Climate Change", "Long-term changes in Earth's climate system"),
+        ("Carbon Neutrality", "Net zero carbon dioxide emissions"),
+        ("Paris Agreement", "A 2015 climate treaty"),
+    ]
+
+
+def test_bold_terms_with_full_width_gloss():
+    understanding = """关键概念：
+**碳中和**（carbon neutrality）：指二氧化碳净排放量为零。
+- **温室气体**（Greenhouse Gases）：大气中吸收红外辐射的气体。
+2. 可持续发展(sustainable development) - 满足当代需求而不损害后代
+**Greenhouse Gases** - Gases that trap heat
+"""
+    assert extract_terms(understanding) == [
+        ("碳中和", "(carbon neutrality) 指二氧化碳净排放量为零。"),
+        ("温室气体", "(Greenhouse Gases) 大气中吸收红外辐射的气体。"),
+        ("可持续发展", "(sustainable development) 满足当代需求而不损害后代"),
+        ("Greenhouse Gases", "Gases that trap heat"),
+    ]
+
+
+def test_heading_words_are_not_terms():
+    understanding = """- 定义：碳中和是指二氧化碳净排放量为零。
+**解释**：通过植树造林等方式抵消排放。
+1. 例子 - 企业购买碳汇
+- Definition: Net zero emissions
+- **Example**: Planting forests
+- 碳汇：吸收二氧化碳的过程
+"""
+    assert extract_terms(understanding) == [("碳汇", "吸收二氧化碳的过程")]
+
+
+def test_gloss_ties_target_terms_to_source_terms():
+    cache = TerminologyCache()
+    cache.update("zh-en", "source", "**碳中和**（carbon neutrality）：二氧化碳净排放为零。")
+    cache.update(
+        "zh-en", "target", "**Net Zero**（碳中和）：Emissions balanced by removals.", source_terms=["碳中和"]
+    )
+    assert cache.lookup("中国承诺实现碳中和。", "zh-en", "target") == [
+        ("Net Zero", "(碳中和) Emissions balanced by removals.")
+    ]
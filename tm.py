@@ -0,0 +1,170 @@
+# Translation Memory
+import json
+import math
+import re
+from array import array
+from collections import Counter
+
+from store import is_error
+
+
+def normalize(sentence):
+    """Collapse whitespace, the only difference tolerated by exact matches"""
+    return re.sub(r"\s+", " ", sentence.strip())
+
+
+def direction_of(path, default="zh-en"):
+    """Direction of a result file, from names like culture-ibut-en-zh.jsonl; `default` otherwise"""
+    match = re.search(r"-([a-z]{2})-([a-z]{2})\.jsonl$", path)
+    return f"{match.group(1)}-{match.group(2)}" if match else default
+
+
+class TranslationMemory:
+    """
+    Exact and fuzzy translation memory
+
+    Exact matches are a dict lookup on the normalized source. Fuzzy matches are
+    found through an inverted index from character n-grams to entries and scored
+    by the Dice coefficient of the n-gram sets. Only the rarest n-grams of a query
+    are used to generate candidates: a candidate sharing none of them cannot
+    reach `threshold`. For long sentences the number probed is further capped at
+    `max_probes`, which keeps lookups fast even when many sentences share a
+    template, at the cost of occasionally missing a borderline match.
+    """
+
+    def __init__(self, ngram=3, threshold=0.7, skip_threshold=0.9, max_probes=8, max_candidates=8):
+        """
+        Initialize translation memory
+
+        Args:
+            ngram: Character n-gram length of the fuzzy index
+            threshold: Minimum Dice similarity of a fuzzy match
+            skip_threshold: Similarity from which IBUT skips refinement for a fuzzy
+                match; below it, refinement is shortened to one round
+            max_probes: Maximum number of n-grams looked up in the index per lookup
+            max_candidates: Maximum number of candidates scored per lookup, those
+                sharing the most probed n-grams first
+        """
+        self.ngram = ngram
+        self.threshold = threshold
+        self.skip_threshold = skip_threshold
+        self.max_probes = max_probes
+        self.max_candidates = max_candidates
+        self.sources = []
+        self.translations = []
+        self._exact = {}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def grams(self, sentence):
+        """Set of character n-grams of a normalized sentence"""
+        if len(sentence) <= self.ngram:
+            return {sentence}
+        return {sentence[i:i + self.ngram] for i in range(len(sentence) - self.ngram + 1)}
+
+    def add(self, source, translation, direction="zh-en"):
+        """Store a translation; a later translation of the same source replaces the earlier one"""
+        source = normalize(source)
+        key = (direction, source)
+        entry = self._exact.get(key)
+        if entry is not None:
+            self.translations[entry] = translation
+            return
+        entry = len(self.sources)
+        self.sources.append(source)
+        self.translations.append(translation)
+        self._exact[key] = entry
+        postings = self._postings.setdefault(direction, {})
+        for gram in self.grams(source):
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array("l")
+            posting.append(entry)
+
+    def load(self, path, direction=None):
+        """
+        Add the successful translations of a result JSONL file
+
+        Args:
+            path: JSONL file with {"src", "hyp"} records
+            direction: Translation direction, inferred from the file name if None
+
+        Returns:
+            int: Number of translations added
+        """
+        direction = direction or direction_of(path)
+        added = 0
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if is_error(record.get("hyp")) or not record["hyp"].strip():
+                    continue
+                self.add(record["src"], record["hyp"].strip(), direction)
+                added += 1
+        return added
+
+    @classmethod
+    def from_results(cls, paths, **kwargs):
+        """Translation memory populated from past result files, e.g. glob("result/*.jsonl")"""
+        memory = cls(**kwargs)
+        for path in paths:
+            memory.load(path)
+        return memory
+
+    def exact(self, source, direction="zh-en"):
+        """Stored translation of exactly this source, or None"""
+        entry = self._exact.get((direction, normalize(source)))
+        return None if entry is None else self.translations[entry]
+
+    def fuzzy(self, source, direction="zh-en"):
+        """
+        Most similar stored sentence
+
+        Returns:
+            dict: {"source", "translation", "similarity"} of the best match at or
+                above `threshold`, or None
+        """
+        postings = self._postings.get(direction)
+        if not postings:
+            return None
+        source = normalize(source)
+        grams = self.grams(source)
+        # A match of Dice similarity t shares at least t * |grams| / (2 - t) n-grams,
+        # so it must contain one of the |grams| - that + 1 rarest ones
+        required = math.ceil(self.threshold * len(grams) / (2 - self.threshold))
+        rare = sorted((len(postings.get(gram, ())), gram) for gram in grams)
+        candidates = Counter()
+        for _, gram in rare[:min(len(grams) - required + 1, self.max_probes)]:
+            candidates.update(postings.get(gram, ()))
+
+        # Lengths bound the n-gram counts, and so the reachable similarity
+        shortest = len(source) * self.threshold / (2 - self.threshold) - self.ngram
+        longest = len(source) * (2 - self.threshold) / self.threshold + self.ngram
+        best = None
+        for entry, _ in candidates.most_common(self.max_candidates):
+            candidate = self.sources[entry]
+            if not shortest <= len(candidate) <= longest:
+                continue
+            candidate_grams = self.grams(candidate)
+            similarity = 2 * len(grams & candidate_grams) / (len(grams) + len(candidate_grams))
+            if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                best = {"source": candidate, "translation": self.translations[entry], "similarity": similarity}
+        return best
+
+    def lookup(self, source, direction="zh-en"):
+        """
+        Exact match if there is one, otherwise the best fuzzy match
+
+        Returns:
+            dict: {"source", "translation", "similarity"}, similarity 1.0 for exact
+                matches, or None
+        """
+        translation = self.exact(source, direction)
+        if translation is not None:
+            return {"source": normalize(source), "translation": translation, "similarity": 1.0}
+        return self.fuzzy(source, direction)